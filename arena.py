@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compact PMtrie backend: nodes live in flat arrays instead of one Python
+# object per node. Same root hashes and proofs as PMtrie.
+#
+# A node is an index into the per-node arrays. Its prefix is not stored
+# separately: it is the nibbles [depth, depth+plen) of the path of any leaf
+# below it (ref), so prefixes come straight out of the packed leaf paths.
+
+from array import array
+
+from helpers import *
+from pmtrie import PMtrie, PMproof
+
+KIND_LEAF   = 1
+KIND_BRANCH = 2
+
+class PMarena:
+
+    def __init__(self):
+        self.root   = -1
+        # per node
+        self.kind   = bytearray()
+        self.depth  = bytearray()
+        self.plen   = bytearray()
+        self.slot   = array('i')    # leaf: leaf index, branch: children row
+        self.ref    = array('i')    # leaf index whose path holds the prefix
+        self.sizes  = array('i')
+        self.hashes = bytearray()
+        # per branch, 16 node indices, -1 for no child
+        self.children = array('i')
+        # per leaf
+        self.paths  = bytearray()
+        self.values = []
+
+    @staticmethod
+    def FromList(l):
+        t = PMarena()
+        for d in l:
+            t.insert(d['key'], d['value'])
+        return t
+
+    @property
+    def hash(self):
+        return self.node_hash(self.root) if self.root >= 0 else NULL_HASH
+
+    @property
+    def size(self):
+        return self.sizes[self.root] if self.root >= 0 else 0
+
+    def node_hash(self, node):
+        return bytes(self.hashes[node*DIGEST_LENGTH:(node+1)*DIGEST_LENGTH])
+
+    def path_nibble(self, leaf, i):
+        b = self.paths[leaf*32 + (i >> 1)]
+        return b & 0x0F if i & 1 else b >> 4
+
+    def path_hex(self, leaf):
+        return bytes(self.paths[leaf*32:(leaf+1)*32]).hex()
+
+    def prefix(self, node):
+        d = self.depth[node]
+        return self.path_hex(self.ref[node])[d:d+self.plen[node]]
+
+    def child_hashes(self, node):
+        row = self.slot[node]*16
+        return [self.node_hash(c) if c >= 0 else None for c in self.children[row:row+16]]
+
+    def new_node(self, kind, depth, plen, slot, ref, size):
+        self.kind.append(kind)
+        self.depth.append(depth)
+        self.plen.append(plen)
+        self.slot.append(slot)
+        self.ref.append(ref)
+        self.sizes.append(size)
+        self.hashes.extend(NULL_HASH)
+        return len(self.kind) - 1
+
+    def new_leaf(self, path, value, depth):
+        leaf = len(self.values)
+        self.paths.extend(path)
+        self.values.append(value)
+        node = self.new_node(KIND_LEAF, depth, 64 - depth, leaf, leaf, 1)
+        self.rehash(node)
+        return node
+
+    def new_branch(self, depth, plen, ref, size):
+        row = len(self.children) // 16
+        self.children.extend([-1]*16)
+        return self.new_node(KIND_BRANCH, depth, plen, row, ref, size)
+
+    def rehash(self, node):
+        if self.kind[node] == KIND_LEAF:
+            h = PMtrie.ComputeHash(self.prefix(node), value=digest(self.values[self.slot[node]]))
+        else:
+            h = PMtrie.ComputeHash(self.prefix(node), root=merkle_root(self.child_hashes(node)))
+        self.hashes[node*DIGEST_LENGTH:(node+1)*DIGEST_LENGTH] = h
+
+    def insert(self, key, value):
+        path  = bytes.fromhex(to_path(key))
+        value = encode_string(value)
+
+        def nib(i):
+            b = path[i >> 1]
+            return b & 0x0F if i & 1 else b >> 4
+
+        if self.root < 0:
+            self.root = self.new_leaf(path, value, 0)
+            return self
+
+        parents = []
+        parent_cell = None
+        node = self.root
+        while True:
+            d = self.depth[node]
+            end = d + self.plen[node]
+            ref = self.ref[node]
+            i = d
+            while i < end and self.path_nibble(ref, i) == nib(i):
+                i += 1
+
+            if i < end:
+                # split node's prefix at i with a new branch
+                branch = self.new_branch(d, i - d, ref, self.sizes[node] + 1)
+                self.depth[node] = i + 1
+                self.plen[node]  = end - i - 1
+                self.rehash(node)
+                leaf = self.new_leaf(path, value, i + 1)
+                row = self.slot[branch]*16
+                self.children[row + self.path_nibble(ref, i)] = node
+                self.children[row + nib(i)] = leaf
+                self.rehash(branch)
+                if parent_cell is None:
+                    self.root = branch
+                else:
+                    self.children[parent_cell] = branch
+                break
+
+            if self.kind[node] == KIND_LEAF:
+                raise Exception("duplicate key")
+
+            parents.append(node)
+            parent_cell = self.slot[node]*16 + nib(end)
+            child = self.children[parent_cell]
+            if child < 0:
+                self.children[parent_cell] = self.new_leaf(path, value, end + 1)
+                break
+            node = child
+
+        for p in reversed(parents):
+            self.sizes[p] += 1
+            self.rehash(p)
+        return self
+
+    def prove(self, key):
+        path = to_path(key)
+        trail = []
+        node = self.root
+        if node < 0:
+            raise Exception("can't do this")
+        while self.kind[node] == KIND_BRANCH:
+            end = self.depth[node] + self.plen[node]
+            assert path[self.depth[node]:end] == self.prefix(node)
+            me = nibble(path[end])
+            trail.append((node, me))
+            node = self.children[self.slot[node]*16 + me]
+            assert node >= 0
+
+        leaf = self.slot[node]
+        assert self.path_hex(leaf) == path
+
+        proof = PMproof(path, self.values[leaf])
+        for branch, me in trail:
+            row = self.slot[branch]*16
+            others = [(i, c) for i, c in enumerate(self.children[row:row+16]) if c >= 0 and i != me]
+            if len(others) == 1:
+                i, neighbor = others[0]
+                if self.kind[neighbor] == KIND_LEAF:
+                    proof.steps.append({
+                        'type': PMproof.TYPE_LEAF,
+                        'skip': self.plen[branch],
+                        'neighbor': {
+                            'key': self.path_hex(self.slot[neighbor]),
+                            'value': digest(self.values[self.slot[neighbor]]),
+                            }
+                        })
+                else:
+                    proof.steps.append({
+                        'type': PMproof.TYPE_FORK,
+                        'skip': self.plen[branch],
+                        'neighbor': {
+                            'prefix': nibbles(self.prefix(neighbor)),
+                            'nibble': i,
+                            'root': merkle_root(self.child_hashes(neighbor)),
+                            }
+                        })
+            else:
+                proof.steps.append({
+                    'type': PMproof.TYPE_BRANCH,
+                    'skip': self.plen[branch],
+                    'neighbors': merkle_proof(self.child_hashes(branch), me),
+                    })
+        return proof
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# usage: python bench.py build [N ...]
+#        python bench.py memory [N ...]
+#        python bench.py parallel [N ...]
+#        python bench.py forest [N ...]
+#        python bench.py suite [N ...] [--samples S] [--json out.json]
+#        python bench.py compare before.json after.json
+# e.g.   python bench.py build 10000 1000000 10000000
+#        python bench.py suite 1000 10000 100000 1000000 10000000 --json rev.json
+
+import argparse
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import helpers
+from pmtrie import *
+from arena import PMarena
+from parallel import build_parallel
+from forest import PMforest
+
+def synthetic_items(n):
+    return [{'key': f'key-{i}', 'value': f'value-{i}'} for i in range(n)]
+
+def timed(f, *args):
+    t0 = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - t0
+
+def bench_build(sizes):
+    print(f"{'n':>10} {'FromList':>12} {'FromBulk':>12} {'speedup':>8}")
+    for n in sizes:
+        items = synthetic_items(n)
+        t_bulk, dt_bulk = timed(PMtrie.FromBulk, items)
+        t_list, dt_list = timed(PMtrie.FromList, items)
+        assert t_bulk.hash == t_list.hash
+        print(f"{n:>10} {dt_list:>11.3f}s {dt_bulk:>11.3f}s {dt_list/dt_bulk:>7.1f}x")
+
+def traced(f, *args):
+    tracemalloc.start()
+    result = f(*args)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current
+
+def bench_memory(sizes):
+    print(f"{'n':>10} {'PMtrie':>12} {'PMarena':>12} {'ratio':>8}")
+    for n in sizes:
+        items = synthetic_items(n)
+        t_trie, m_trie = traced(PMtrie.FromBulk, items)
+        t_arena, m_arena = traced(PMarena.FromList, items)
+        assert t_trie.hash == t_arena.hash
+        print(f"{n:>10} {m_trie/2**20:>10.1f}MB {m_arena/2**20:>10.1f}MB {m_trie/m_arena:>7.1f}x")
+
+def bench_parallel(sizes):
+    print(f"{'n':>10} {'FromBulk':>12} {'parallel':>12} {'speedup':>8}")
+    for n in sizes:
+        items = synthetic_items(n)
+        t_bulk, dt_bulk = timed(PMtrie.FromBulk, items)
+        t_par, dt_par = timed(build_parallel, items)
+        assert t_bulk.hash == t_par.hash
+        print(f"{n:>10} {dt_bulk:>11.3f}s {dt_par:>11.3f}s {dt_bulk/dt_par:>7.1f}x")
+
+def bench_forest(sizes, batch=1000):
+    print(f"{'n':>10} {'shards':>6} {'insert/s':>10} {'prove/s':>10}")
+    for n in sizes:
+        items = synthetic_items(n)
+        keys = [d['key'] for d in items[:batch]]
+        for shards in [1, 2, 4, 8]:
+            forest = PMforest(shards)
+            _, dt_insert = timed(lambda: [forest.insert_many(items[i:i+batch]) for i in range(0, n, batch)])
+            _, dt_prove = timed(forest.prove_many, keys)
+            assert forest.hash == PMtrie.FromBulk(items).hash
+            forest.close()
+            print(f"{n:>10} {shards:>6} {n/dt_insert:>10.0f} {len(keys)/dt_prove:>10.0f}")
+
+
+class Blake2bCounter:
+    # counts blake2b calls made through helpers while active
+
+    def __init__(self):
+        self.calls = 0
+
+    def __enter__(self):
+        original = self.original = helpers.blake2b
+        def counting(*args, **kwargs):
+            self.calls += 1
+            return original(*args, **kwargs)
+        helpers.blake2b = counting
+        return self
+
+    def __exit__(self, *exc):
+        helpers.blake2b = self.original
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def measure(op, n, fn, args):
+    latencies = []
+    with Blake2bCounter() as counter:
+        t0 = time.perf_counter()
+        for a in args:
+            t = time.perf_counter_ns()
+            fn(a)
+            latencies.append(time.perf_counter_ns() - t)
+        total = time.perf_counter() - t0
+    latencies.sort()
+    return {
+        'op': op,
+        'n': n,
+        'count': len(args),
+        'ops_per_s': len(args) / total if total > 0 else 0,
+        'p50_us': percentile(latencies, 50) / 1000,
+        'p95_us': percentile(latencies, 95) / 1000,
+        'p99_us': percentile(latencies, 99) / 1000,
+        'blake2b_per_op': counter.calls / len(args),
+        'peak_rss_mb': peak_rss_mb(),
+        }
+
+def run_suite(sizes, samples, seed=42):
+    rng = random.Random(seed)
+    results = []
+    for n in sizes:
+        items = synthetic_items(n)
+        t = PMtrie()
+        results.append(measure('insert', n, lambda d: t.insert(d['key'], d['value']), items))
+
+        keys = [d['key'] for d in rng.sample(items, min(n, samples))]
+        results.append(measure('prove', n, t.prove, keys))
+
+        proofs = [t.prove(k) for k in keys]
+        results.append(measure('verify', n, lambda p: p.verify(), proofs))
+        results.append(measure('toCBOR', n, lambda p: p.toCBOR(), proofs))
+        results.append(measure('toJSON', n, lambda p: p.toJSON(), proofs))
+
+        children = [[digest(bytes([i % 256, j])) if rng.random() < 0.7 else None for j in range(16)] for i in range(min(n, samples))]
+        results.append(measure('merkle_root', n, merkle_root, children))
+    return results
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def print_results(results):
+    print(f"{'op':>12} {'n':>10} {'ops/s':>12} {'p50us':>9} {'p95us':>9} {'p99us':>9} {'blake2b':>8} {'rssMB':>8}")
+    for r in results:
+        print(f"{r['op']:>12} {r['n']:>10} {r['ops_per_s']:>12.0f} {r['p50_us']:>9.1f} {r['p95_us']:>9.1f} {r['p99_us']:>9.1f} {r['blake2b_per_op']:>8.1f} {r['peak_rss_mb']:>8.1f}")
+
+def bench_suite(sizes, samples, output=None):
+    results = run_suite(sizes, samples)
+    print_results(results)
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump({'revision': revision(), 'python': platform.python_version(), 'results': results}, f, indent=2)
+
+def bench_compare(before, after):
+    with open(before) as f:
+        a = {(r['op'], r['n']): r for r in json.load(f)['results']}
+    with open(after) as f:
+        b = {(r['op'], r['n']): r for r in json.load(f)['results']}
+    print(f"{'op':>12} {'n':>10} {'ops/s':>10} {'p99':>10} {'blake2b':>10}")
+    for k in sorted(set(a) & set(b)):
+        ra, rb = a[k], b[k]
+        print(f"{k[0]:>12} {k[1]:>10} {rb['ops_per_s']/ra['ops_per_s']:>9.2f}x {rb['p99_us']/ra['p99_us']:>9.2f}x {rb['blake2b_per_op']-ra['blake2b_per_op']:>+10.1f}")
+
+COMMANDS = {
+    'build': bench_build,
+    'memory': bench_memory,
+    'parallel': bench_parallel,
+    'forest': bench_forest,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name in COMMANDS:
+        sub.add_parser(name).add_argument('sizes', type=int, nargs='*', default=[10000])
+    suite = sub.add_parser('suite')
+    suite.add_argument('sizes', type=int, nargs='*', default=[1000, 10000])
+    suite.add_argument('--samples', type=int, default=1000)
+    suite.add_argument('--json')
+    compare = sub.add_parser('compare')
+    compare.add_argument('before')
+    compare.add_argument('after')
+    args = parser.parse_args()
+
+    if args.command == 'suite':
+        bench_suite(args.sizes, args.samples, args.json)
+    elif args.command == 'compare':
+        bench_compare(args.before, args.after)
+    else:
+        COMMANDS[args.command](args.sizes)
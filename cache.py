@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# LRU cache of proofs keyed by (root hash, path), together with their
+# serialized forms. Mutations made through the cache are logged by path;
+# when the root has moved on, the latest cached proof of a key is rebased
+# instead of proven from scratch: a step only depends on the children of
+# its branch, so it has to be recomputed only if a mutated path leaves the
+# key's path exactly at that branch's nibble, or if the branch itself moved.
+
+from collections import OrderedDict, deque
+
+from helpers import *
+from pmtrie import PMtrie, PMproof
+
+class CachedProof:
+
+    def __init__(self, root, seq, proof):
+        self.root  = root
+        self.seq   = seq
+        self.proof = proof
+        self.json  = None
+        self.cbor  = None
+
+
+class PMproofcache:
+
+    def __init__(self, trie, capacity=10000, log_size=1024):
+        self.trie     = trie
+        self.capacity = capacity
+        self.entries  = OrderedDict()
+        self.latest   = {}
+        self.log      = deque(maxlen=log_size)
+        self.seq      = 0
+        self.root     = trie.hash
+        self.hits     = 0
+        self.misses   = 0
+        self.rebases  = 0
+
+    def sync_root(self):
+        # a root we didn't log means the trie was mutated behind our back,
+        # the log can't be trusted for rebasing across that change
+        root = self.trie.commit()
+        if root != self.root:
+            self.latest = {}
+            self.root = root
+        return root
+
+    def mutated(self, path):
+        self.seq += 1
+        self.log.append((self.seq, path))
+        self.root = self.trie.hash
+
+    def insert(self, key, value):
+        self.sync_root()
+        self.trie.insert(key, value)
+        self.mutated(to_path(key))
+        return self
+
+    def update(self, key, value):
+        self.sync_root()
+        self.trie.update(key, value)
+        self.mutated(to_path(key))
+        return self
+
+    def delete(self, key):
+        self.sync_root()
+        self.trie.delete(key)
+        self.mutated(to_path(key))
+        return self
+
+    def changes_since(self, seq):
+        # paths mutated after seq, or None if the log no longer reaches back that far
+        if self.seq - seq > len(self.log):
+            return None
+        return [path for s, path in self.log if s > seq]
+
+    def rebase(self, path, previous):
+        changed = self.changes_since(previous.seq)
+        if changed is None:
+            return None
+        trail, leaf = self.trie.locate(path)
+        if leaf is None:
+            return None
+
+        affected = set(len(common_prefix(path, other)) for other in changed)
+        old_steps = {}
+        cursor = 0
+        for step in previous.proof.steps:
+            old_steps[cursor] = step
+            cursor += step['skip'] + 1
+
+        proof = PMproof(path, leaf.value)
+        cursor = 0
+        for node, branch in trail:
+            skip = len(node.prefix)
+            step = old_steps.get(cursor)
+            if step is None or step['skip'] != skip or cursor + skip in affected:
+                step = node.proof_step(branch)
+            proof.steps.append(step)
+            cursor += skip + 1
+        return proof
+
+    def lookup(self, key):
+        root = self.sync_root()
+
+        path = to_path(key)
+        entry = self.entries.get((root, path))
+        if entry is not None:
+            self.hits += 1
+            self.entries.move_to_end((root, path))
+            return entry
+
+        self.misses += 1
+        proof = None
+        previous = self.latest.get(path)
+        if previous is not None:
+            proof = self.rebase(path, previous)
+            if self.trie.source is not None:
+                self.trie.source.trim()
+        if proof is not None:
+            self.rebases += 1
+        else:
+            proof = self.trie.prove(key)
+
+        entry = CachedProof(root, self.seq, proof)
+        self.entries[(root, path)] = entry
+        self.latest[path] = entry
+        while len(self.entries) > self.capacity:
+            (_, old_path), old = self.entries.popitem(last=False)
+            if self.latest.get(old_path) is old:
+                del self.latest[old_path]
+        return entry
+
+    def prove(self, key):
+        # the returned proof is shared with the cache and must not be modified
+        return self.lookup(key).proof
+
+    def prove_json(self, key):
+        entry = self.lookup(key)
+        if entry.json is None:
+            entry.json = entry.proof.toJSON()
+        return entry.json
+
+    def prove_cbor(self, key):
+        entry = self.lookup(key)
+        if entry.cbor is None:
+            entry.cbor = entry.proof.toCBOR()
+        return entry.cbor
+
+    def clear(self):
+        self.entries.clear()
+        self.latest = {}
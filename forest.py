@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# A trie sharded over worker processes by the leading nibble of the path.
+# Every worker keeps one subtrie per nibble it owns and reports it to the
+# coordinator as a descriptor, enough to hash the subtrie as a child of the
+# root and to build the top proof step:
+#
+#   ('leaf', path, value digest)        a single key below the nibble
+#   ('branch', prefix, merkle root)     prefix starts with the nibble
+#
+# The coordinator hashes the top branch from the descriptors, so the root is
+# the same as for one PMtrie holding all keys, and prepends the top step to
+# the proofs the workers produce.
+
+from multiprocessing import Pipe, Process
+
+from helpers import *
+from pmtrie import PMtrie, PMproof
+
+def describe(trie):
+    if trie.get_type() == PMtrie.TYPE_ROOT:
+        return None
+    if trie.get_type() == PMtrie.TYPE_LEAF:
+        return ('leaf', trie.leaf_path(), trie.value_digest())
+    trie.commit()
+    return ('branch', trie.prefix, trie.compute_root())
+
+def shard_worker(conn, nibbles):
+    tries = {n: PMtrie() for n in nibbles}
+
+    def handle(op, args):
+        if op == 'insert':
+            for path, key, value in args:
+                tries[nibble(path[0])].insert_prehashed(path, value, key=key)
+        elif op == 'update':
+            for path, key, value in args:
+                tries[nibble(path[0])].update(key, value)
+        elif op == 'delete':
+            for path, key in args:
+                tries[nibble(path[0])].delete(key)
+        elif op == 'prove':
+            return [tries[nibble(path[0])].proof_at(path) for path in args]
+        elif op == 'size':
+            return sum(t.size for t in tries.values())
+        elif op == 'describe':
+            return {n: describe(t) for n, t in tries.items()}
+        else:
+            raise Exception(f"unknown op {op}")
+        touched = set(nibble(entry[0][0]) for entry in args)
+        return {n: describe(tries[n]) for n in touched}
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        try:
+            conn.send(('ok', handle(*message)))
+        except Exception as e:
+            conn.send(('error', str(e) or type(e).__name__))
+    conn.close()
+
+
+class PMforest:
+
+    def __init__(self, shards=4):
+        assert 1 <= shards <= 16
+        self.shards = []
+        self.owner = [n * shards // 16 for n in range(16)]
+        for i in range(shards):
+            parent, child = Pipe()
+            process = Process(target=shard_worker, args=(child, [n for n in range(16) if self.owner[n] == i]), daemon=True)
+            process.start()
+            self.shards.append((process, parent))
+        self.descriptors = [None]*16
+        self.levels = None
+
+    def request(self, batches):
+        # sends every shard its batch at once, then collects the answers
+        for i, (op, args) in batches.items():
+            self.shards[i][1].send((op, args))
+        results = {}
+        errors = []
+        for i in batches:
+            status, result = self.shards[i][1].recv()
+            if status == 'error':
+                errors.append(result)
+            results[i] = result
+        if len(errors) > 0:
+            raise Exception(errors[0])
+        return results
+
+    def write(self, op, entries):
+        # entries are tuples starting with the path; the shards report back
+        # the descriptors of the subtries that changed
+        batches = {}
+        for entry in entries:
+            batches.setdefault(self.owner[nibble(entry[0][0])], (op, []))[1].append(entry)
+        self.levels = None
+        try:
+            results = self.request(batches)
+        except Exception:
+            # part of a batch may have been applied before the error
+            self.refresh()
+            raise
+        for changed in results.values():
+            for n, descriptor in changed.items():
+                self.descriptors[n] = descriptor
+        return self
+
+    def refresh(self):
+        self.levels = None
+        for changed in self.request({i: ('describe', None) for i in range(len(self.shards))}).values():
+            for n, descriptor in changed.items():
+                self.descriptors[n] = descriptor
+
+    def insert_many(self, items):
+        return self.write('insert', [(to_path(d['key']), d['key'], d['value']) for d in items])
+
+    def insert(self, key, value):
+        return self.write('insert', [(to_path(key), key, value)])
+
+    def update(self, key, value):
+        return self.write('update', [(to_path(key), key, value)])
+
+    def delete(self, key):
+        return self.write('delete', [(to_path(key), key)])
+
+    def child_hash(self, n):
+        kind, path, h = self.descriptors[n]
+        if kind == 'leaf':
+            return PMtrie.ComputeHash(path[1:], value=h)
+        return PMtrie.ComputeHash(path[1:], root=h)
+
+    def occupied(self):
+        return [n for n in range(16) if self.descriptors[n] is not None]
+
+    @property
+    def hash(self):
+        occupied = self.occupied()
+        if len(occupied) == 0:
+            return NULL_HASH
+        if len(occupied) == 1:
+            # the only subtrie is the whole trie, prefix and all
+            kind, path, h = self.descriptors[occupied[0]]
+            return PMtrie.ComputeHash(path, value=h) if kind == 'leaf' else PMtrie.ComputeHash(path, root=h)
+        return PMtrie.ComputeHash('', root=self.top_levels()[4][0])
+
+    def top_levels(self):
+        if self.levels is None:
+            self.levels = merkle_levels([self.child_hash(n) if self.descriptors[n] is not None else None for n in range(16)])
+        return self.levels
+
+    def top_step(self, me):
+        others = [n for n in self.occupied() if n != me]
+        if len(others) == 1:
+            kind, path, h = self.descriptors[others[0]]
+            if kind == 'leaf':
+                return {'type': PMproof.TYPE_LEAF, 'skip': 0, 'neighbor': {'key': path, 'value': h}}
+            return {'type': PMproof.TYPE_FORK, 'skip': 0, 'neighbor': {'prefix': nibbles(path[1:]), 'nibble': others[0], 'root': h}}
+        return {'type': PMproof.TYPE_BRANCH, 'skip': 0, 'neighbors': merkle_neighbors(self.top_levels(), me)}
+
+    def prove_many(self, keys):
+        paths = [to_path(key) for key in keys]
+        batches = {}
+        for path in paths:
+            batches.setdefault(self.owner[nibble(path[0])], ('prove', []))[1].append(path)
+        results = {i: iter(proofs) for i, proofs in self.request(batches).items()}
+
+        single = len(self.occupied()) == 1
+        proofs = []
+        for path in paths:
+            proof = next(results[self.owner[nibble(path[0])]])
+            if not single:
+                # the top branch takes the first nibble off the shard's first step
+                if len(proof.steps) > 0:
+                    proof.steps[0] = dict(proof.steps[0], skip=proof.steps[0]['skip'] - 1)
+                proof.steps.insert(0, self.top_step(nibble(path[0])))
+            proofs.append(proof)
+        return proofs
+
+    def prove(self, key):
+        return self.prove_many([key])[0]
+
+    @property
+    def size(self):
+        return sum(self.request({i: ('size', None) for i in range(len(self.shards))}).values())
+
+    def close(self):
+        for process, conn in self.shards:
+            conn.send(None)
+            process.join()
+            conn.close()
+        self.shards = []
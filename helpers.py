@@ -4,11 +4,10 @@ DIGEST_LENGTH = 32
 NULL_HASH = bytes([0]*DIGEST_LENGTH)
 
 def common_prefix(a,b):
-    i=0
-    while i<len(a) and i<len(b) and a[:i] == b[:i]:
-        i+=1
-    if a[:i] != b[:i]:
-        i-=1
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i] == b[i]:
+        i += 1
     return a[:i]
 
 def nibble(c):
@@ -17,6 +16,14 @@ def nibble(c):
 def nibbles(a):
     return bytes([nibble(x) for x in a])
 
+def pack_nibbles(a):
+    return bytes([len(a)]) + bytes.fromhex(a + '0' if len(a) % 2 == 1 else a)
+
+def unpack_nibbles(b, offset=0):
+    n = b[offset]
+    a = bytes(b[offset+1:offset+1+(n+1)//2]).hex()[:n]
+    return a, offset + 1 + (n+1)//2
+
 def encode_string(s):
     if type(s) is str:
         return s.encode('utf-8')
@@ -47,6 +54,17 @@ def digest(b):
 def hexdigest(b):
     return blake2b(b, digest_size=32).hexdigest()
 
+# EMPTY_HASHES[d] is the root of a subtree of height d with only NULL leaves
+EMPTY_HASHES = [NULL_HASH]
+for _ in range(4):
+    EMPTY_HASHES.append(digest(EMPTY_HASHES[-1] + EMPTY_HASHES[-1]))
+
+def merkle_pair(left, right, depth):
+    empty = EMPTY_HASHES[depth]
+    if left == empty and right == empty:
+        return EMPTY_HASHES[depth+1]
+    return digest(left + right)
+
 def merkle_root(children, size=16):
     nodes = [(x if type(x) is bytes else x.hash) if x is not None else NULL_HASH for x in children]
     n = len(nodes)
@@ -55,34 +73,60 @@ def merkle_root(children, size=16):
         return nodes[0]
     assert n >= 2 and n % 2 == 0
 
-    while True:
-        for i in range(n//2):
-            nodes.append(digest(nodes[0]+nodes[1]))
-            nodes = nodes[2:]
-        n = len(nodes)
-        if n < 2:
-            break
+    depth = 0
+    while len(nodes) > 1:
+        nodes = [merkle_pair(nodes[i], nodes[i+1], depth) for i in range(0, len(nodes), 2)]
+        depth += 1
     return nodes[0]
 
+def merkle_levels(children):
+    # all levels of the 16 leaf merkle tree, leaves first and root last
+    level = [(x if type(x) is bytes else x.hash) if x is not None else NULL_HASH for x in children]
+    assert len(level) == 16
+    levels = [level]
+    for depth in range(4):
+        level = [merkle_pair(level[i], level[i+1], depth) for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+def merkle_update(levels, me:int, h):
+    # replaces leaf me and rehashes the 4 nodes above it
+    levels[0][me] = h
+    for depth in range(4):
+        me >>= 1
+        levels[depth+1][me] = merkle_pair(levels[depth][2*me], levels[depth][2*me+1], depth)
+    return levels[4][0]
+
+def merkle_neighbors(levels, me:int):
+    return [levels[3][(me >> 3) ^ 1], levels[2][(me >> 2) ^ 1], levels[1][(me >> 1) ^ 1], levels[0][me ^ 1]]
+
 def merkle_proof(nodes, me:int):
-    assert len(nodes) > 1 and len(nodes) % 2 == 0
+    assert len(nodes) == 16
     assert me >=0 and me <len(nodes)
+    return merkle_neighbors(merkle_levels(nodes), me)
+
+def cbor_head(major, n):
+    if n < 24:
+        return bytes([(major << 5) | n])
+    elif n < 0x100:
+        return bytes([(major << 5) | 24, n])
+    elif n < 0x10000:
+        return bytes([(major << 5) | 25]) + n.to_bytes(2, 'big')
+    else:
+        return bytes([(major << 5) | 26]) + n.to_bytes(4, 'big')
 
-    neighbors = []
-    pivot = 8
-    n = 8
-    while True:
-        if me < pivot:
-            neighbors.append(merkle_root(nodes[pivot:pivot+n], size=n))
-            pivot -= (n >> 1)
-        else:
-            neighbors.append(merkle_root(nodes[pivot-n:pivot], size=n))
-            pivot += (n >> 1)
-        n = n >> 1
-        if n < 1:
-            break
-    
-    return neighbors
+def cbor_read_head(data, pos, major):
+    # returns the argument of the head at pos and the position after it
+    b = data[pos]
+    if b >> 5 != major:
+        raise Exception(f"unexpected CBOR major type at byte {pos}")
+    n = b & 0x1F
+    if n < 24:
+        return n, pos + 1
+    size = {24: 1, 25: 2, 26: 4, 27: 8}.get(n)
+    if size is None:
+        raise Exception(f"unsupported CBOR head at byte {pos}")
+    return int.from_bytes(data[pos+1:pos+1+size], 'big'), pos + 1 + size
 
 def sparse_vector(d):
     return [d.get(x) for x in range(16)]
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Whole-trie image files. save_image writes every node once, children
+# before parents, and open_image maps the file and decodes nodes lazily
+# as they are reached, so processes on one host share the page cache.
+#
+# layout: header (magic, root offset), then records of
+#   hash | kind | packed prefix | leaf: key, value (see store.encode_leaf)
+#                               | branch: size, bitmap, child offsets
+
+import mmap
+import struct
+
+from helpers import *
+from pmtrie import PMtrie
+from store import NodeCache, NODE_LEAF, NODE_BRANCH, NODE_HASHED_LEAF, encode_leaf, read_leaf
+
+MAGIC = b'PMIMG\x01\x00\x00'
+NO_ROOT = 0xFFFFFFFFFFFFFFFF
+
+def save_image(trie, path):
+    trie.commit()
+    with open(path, 'wb') as f:
+        f.write(MAGIC + struct.pack('>Q', NO_ROOT))
+
+        def loop(node):
+            if node.get_type() == PMtrie.TYPE_LEAF:
+                record = encode_leaf(node)
+            else:
+                bitmap = 0
+                offsets = []
+                for i, child in enumerate(node.children):
+                    if child is not None:
+                        bitmap |= 1 << i
+                        offsets.append(loop(child))
+                record = bytes([NODE_BRANCH]) + pack_nibbles(node.prefix) + struct.pack('>QH', node.size, bitmap) + struct.pack(f'>{len(offsets)}Q', *offsets)
+            offset = f.tell()
+            f.write(node.hash + record)
+            return offset
+
+        if trie.get_type() != PMtrie.TYPE_ROOT:
+            root = loop(trie)
+            f.seek(len(MAGIC))
+            f.write(struct.pack('>Q', root))
+
+def open_image(path, capacity=100000):
+    image = PMimage(path, capacity)
+    return image.open()
+
+
+class PMimage(NodeCache):
+
+    def __init__(self, path, capacity=100000):
+        super().__init__(capacity)
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise Exception("not a trie image")
+        self.root, = struct.unpack_from('>Q', self.data, len(MAGIC))
+
+    def open(self):
+        if self.root == NO_ROOT:
+            return PMtrie()
+        node = self.stub(self.root)
+        self.resolve(node)
+        return node
+
+    def stub(self, offset):
+        return PMtrie.Stub(self.data[offset:offset+DIGEST_LENGTH], self, offset)
+
+    def resolve(self, node):
+        offset = node.ref
+        data = self.data
+        h = data[offset:offset+DIGEST_LENGTH]
+        kind = data[offset+DIGEST_LENGTH]
+        prefix, pos = unpack_nibbles(data, offset + DIGEST_LENGTH + 1)
+
+        resolved = PMtrie(prefix=prefix, hash=h)
+        if kind == NODE_LEAF or kind == NODE_HASHED_LEAF:
+            read_leaf(data, kind, pos, resolved)
+        elif kind == NODE_BRANCH:
+            resolved.size, bitmap = struct.unpack_from('>QH', data, pos)
+            pos += 10
+            resolved.children = [None]*16
+            for i in range(16):
+                if bitmap & (1 << i):
+                    resolved.children[i] = self.stub(struct.unpack_from('>Q', data, pos)[0])
+                    pos += 8
+        else:
+            raise Exception("unknown node type")
+
+        deferred = node.deferred
+        node.__dict__ = resolved.__dict__
+        node.source = self
+        if deferred:
+            node.deferred = True
+        self.track(node, offset)
+
+    def close(self):
+        self.data.close()
+        self.file.close()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Optional counters and timers for the trie hot paths. enable() swaps in
+# timing wrappers around the helpers and the public operations, disable()
+# puts the original functions back, so nothing is measured (or paid) while
+# instrumentation is off.
+#
+#   with profile() as stats:
+#       t.insert(k, v)
+#   print(stats['digest'])
+
+import sys
+import time
+from contextlib import contextmanager
+
+import helpers
+from pmtrie import PMtrie, PMproof
+
+HELPERS = ['digest', 'hexdigest', 'to_path', 'merkle_root', 'merkle_levels', 'merkle_update', 'merkle_neighbors', 'merkle_proof', 'common_prefix']
+
+METHODS = [
+    (PMtrie, 'insert'), (PMtrie, 'insert_prehashed'), (PMtrie, 'update'), (PMtrie, 'delete'), (PMtrie, 'commit'),
+    (PMtrie, 'prove'), (PMtrie, 'prove_many'), (PMtrie, 'proof_step'),
+    (PMproof, 'verify'),
+    (PMproof, 'toJSON'), (PMproof, 'toCBOR'), (PMproof, 'toCBORbytes'), (PMproof, 'fromCBOR'),
+]
+
+_stats = {}
+_patches = []
+_wrappers = {}
+
+def _wrap(name, fn):
+    record = _stats.setdefault(name, [0, 0])
+    perf_counter_ns = time.perf_counter_ns
+
+    def wrapper(*args, **kwargs):
+        t = perf_counter_ns()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record[0] += 1
+            record[1] += perf_counter_ns() - t
+    return wrapper
+
+def enabled():
+    return len(_patches) > 0
+
+def _modules_holding(name, fn):
+    # every loaded module that has fn under name, e.g. from helpers import *
+    for module in list(sys.modules.values()):
+        if module is not None and getattr(module, '__dict__', {}).get(name) is fn:
+            yield module
+
+def enable():
+    if enabled():
+        return
+    for name in HELPERS:
+        original = getattr(helpers, name)
+        wrapper = _wrap(name, original)
+        _wrappers[name] = (wrapper, original)
+        for module in list(_modules_holding(name, original)):
+            _patches.append((module, name, original))
+            setattr(module, name, wrapper)
+
+    for cls, name in METHODS:
+        original = cls.__dict__[name]
+        label = f"{cls.__name__}.{name}"
+        if isinstance(original, staticmethod):
+            wrapper = staticmethod(_wrap(label, original.__func__))
+        else:
+            wrapper = _wrap(label, original)
+        _patches.append((cls, name, original))
+        setattr(cls, name, wrapper)
+
+def disable():
+    while len(_patches) > 0:
+        target, name, original = _patches.pop()
+        setattr(target, name, original)
+    # modules imported while enabled copied the wrappers from helpers
+    for name, (wrapper, original) in _wrappers.items():
+        for module in list(_modules_holding(name, wrapper)):
+            setattr(module, name, original)
+    _wrappers.clear()
+
+def reset():
+    for record in _stats.values():
+        record[0] = 0
+        record[1] = 0
+
+def stats():
+    # {name: {'calls': n, 'seconds': t}} for everything called so far
+    return {name: {'calls': calls, 'seconds': ns / 1e9} for name, (calls, ns) in _stats.items() if calls > 0}
+
+@contextmanager
+def profile():
+    # enables instrumentation for the block; the yielded dict is filled
+    # with the calls made inside it when the block exits
+    was_enabled = enabled()
+    before = stats()
+    enable()
+    result = {}
+    try:
+        yield result
+    finally:
+        if not was_enabled:
+            disable()
+        for name, s in stats().items():
+            b = before.get(name, {'calls': 0, 'seconds': 0})
+            if s['calls'] > b['calls']:
+                result[name] = {'calls': s['calls'] - b['calls'], 'seconds': s['seconds'] - b['seconds']}
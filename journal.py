@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Write-ahead journal and checkpoints for a live trie. Mutations are
+# appended to the journal and made durable in groups: commit() writes the
+# pending records and a commit record holding the root, then fsyncs once.
+# A checkpoint is the whole trie (dumps_trie) written next to the journal
+# and renamed into place, after which the journal starts over.
+#
+# Recovery loads the checkpoint, replays the journal one committed group at
+# a time and checks every recorded root; a torn group at the end is dropped.
+#
+# journal record: length | crc32 | op | seq | payload
+#   insert/update: key, value   delete: key   commit: root
+
+import os
+import struct
+import time
+import zlib
+
+from helpers import *
+from pmtrie import PMtrie
+from store import dumps_trie, loads_trie
+
+CHECKPOINT_MAGIC = b'PMCKPT\x01\n'
+
+OP_INSERT = 1
+OP_UPDATE = 2
+OP_DELETE = 3
+OP_COMMIT = 4
+
+def encode_record(op, seq, *fields):
+    payload = struct.pack('>BQ', op, seq) + b''.join(struct.pack('>I', len(f)) + f for f in fields)
+    return struct.pack('>II', len(payload), zlib.crc32(payload)) + payload
+
+def read_records(data):
+    # yields (end offset, op, seq, fields) up to the first torn or corrupt record
+    pos = 0
+    while pos + 8 <= len(data):
+        n, crc = struct.unpack_from('>II', data, pos)
+        payload = data[pos+8:pos+8+n]
+        if len(payload) < n or zlib.crc32(payload) != crc:
+            return
+        op, seq = struct.unpack_from('>BQ', payload)
+        fields = []
+        offset = 9
+        while offset < n:
+            m, = struct.unpack_from('>I', payload, offset)
+            fields.append(bytes(payload[offset+4:offset+4+m]))
+            offset += 4 + m
+        pos += 8 + n
+        yield pos, op, seq, fields
+
+def fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class PMjournal:
+
+    def __init__(self, directory, batch=1024, interval=None, checkpoint_every=None):
+        self.directory        = directory
+        self.batch            = batch
+        self.interval         = interval
+        self.checkpoint_every = checkpoint_every
+        self.journal_path     = os.path.join(directory, 'journal')
+        self.checkpoint_path  = os.path.join(directory, 'checkpoint')
+        self.pending          = []
+        self.last_commit      = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+        self.file = open(self.journal_path, 'ab')
+
+    def recover(self):
+        self.trie = PMtrie()
+        self.seq = 0
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'rb') as f:
+                data = f.read()
+            if data[:len(CHECKPOINT_MAGIC)] != CHECKPOINT_MAGIC:
+                raise Exception("not a checkpoint")
+            pos = len(CHECKPOINT_MAGIC)
+            self.seq, = struct.unpack_from('>Q', data, pos)
+            root = data[pos+8:pos+8+DIGEST_LENGTH]
+            self.trie = loads_trie(data[pos+8+DIGEST_LENGTH:], verify=True)
+            if self.trie.hash != root:
+                raise Exception("checkpoint does not match its root")
+        self.checkpoint_seq = self.seq
+        self.root = self.trie.hash
+
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as f:
+            data = f.read()
+
+        self.trie.deferred = True
+        group = []
+        durable = 0
+        for end, op, seq, fields in read_records(memoryview(data)):
+            if op != OP_COMMIT:
+                group.append((op, seq, fields))
+                continue
+            for group_op, group_seq, group_fields in group:
+                if group_seq > self.seq:
+                    self.apply(group_op, *group_fields)
+                    self.seq = group_seq
+            group = []
+            durable = end
+            if seq > self.checkpoint_seq:
+                self.root = self.trie.commit()
+                if self.root != fields[0]:
+                    raise Exception(f"journal replay diverged at {seq}")
+        self.trie.deferred = False
+        self.trie.commit()
+
+        if durable < len(data):
+            # drop the torn tail so new records follow the last commit
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(durable)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def apply(self, op, key, value=None):
+        if op == OP_INSERT:
+            self.trie.insert(key, value)
+        elif op == OP_UPDATE:
+            self.trie.update(key, value)
+        elif op == OP_DELETE:
+            self.trie.delete(key)
+        else:
+            raise Exception("unknown journal op")
+
+    def log(self, op, key, value=None):
+        # applied first, so a failing mutation never reaches the journal
+        self.apply(op, key, value)
+        self.seq += 1
+        fields = (encode_string(key),) if value is None else (encode_string(key), encode_string(value))
+        self.pending.append(encode_record(op, self.seq, *fields))
+        if len(self.pending) >= self.batch or (self.interval is not None and time.monotonic() - self.last_commit >= self.interval):
+            self.commit()
+        return self
+
+    def insert(self, key, value):
+        return self.log(OP_INSERT, key, value)
+
+    def update(self, key, value):
+        return self.log(OP_UPDATE, key, value)
+
+    def delete(self, key):
+        return self.log(OP_DELETE, key)
+
+    def commit(self):
+        # one write and one fsync for all pending mutations
+        self.last_commit = time.monotonic()
+        if len(self.pending) == 0:
+            return self.root
+        self.root = self.trie.commit()
+        self.pending.append(encode_record(OP_COMMIT, self.seq, self.root))
+        self.file.write(b''.join(self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+
+        if self.checkpoint_every is not None and self.seq - self.checkpoint_seq >= self.checkpoint_every:
+            self.checkpoint()
+        return self.root
+
+    def checkpoint(self):
+        self.commit()
+        tmp = self.checkpoint_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(CHECKPOINT_MAGIC + struct.pack('>Q', self.seq) + self.root)
+            f.write(dumps_trie(self.trie))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.checkpoint_path)
+        fsync_directory(self.directory)
+        self.checkpoint_seq = self.seq
+
+        # everything journaled so far is in the checkpoint; a crash before the
+        # truncate only leaves records that recovery skips by their seq
+        self.file.truncate(0)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.root
+
+    def close(self):
+        self.commit()
+        self.file.close()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Parallel trie construction: keys are partitioned by the leading nibbles
+# of their path, every partition is built by FromSorted in a worker process
+# and shipped back with dumps_trie, and the top of the trie is stitched
+# together from the partitions.
+
+from concurrent.futures import ProcessPoolExecutor
+
+from helpers import *
+from pmtrie import PMtrie
+from store import dumps_trie, loads_trie
+
+def build_bucket(entries, depth):
+    entries.sort(key=lambda e: e[0])
+    return dumps_trie(PMtrie.FromSorted(entries, depth=depth))
+
+def build_parallel(l, workers=None, depth=1):
+    buckets = {}
+    for d in l:
+        path = to_path(d['key'])
+        buckets.setdefault(path[:depth], []).append((path, d['key'], d['value']))
+
+    names = sorted(buckets)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        subtries = dict(zip(names, executor.map(build_bucket, [buckets[x] for x in names], [depth]*len(names))))
+
+    def stitch(position):
+        if len(position) == depth:
+            return loads_trie(subtries[position]) if position in subtries else None
+
+        children = {}
+        for i in range(16):
+            child = stitch(position + '%x' % i)
+            if child is not None:
+                children[i] = child
+
+        if len(children) == 0:
+            return None
+        if len(children) == 1:
+            i, child = children.popitem()
+            return child.with_prefix('%x' % i + child.prefix)
+        branch = PMtrie.Branch('', children)
+        branch.size = sum(child.size for child in children.values())
+        return branch
+
+    root = stitch('')
+    return root if root is not None else PMtrie()
@@ -7,6 +7,7 @@
 # WARNING: untested and incomplete implementation
 
 import json
+import struct
 from helpers import *
 
 class PMtrie:
@@ -14,16 +15,46 @@ class PMtrie:
     TYPE_BRANCH = 'branch'
     TYPE_LEAF   = 'leaf'
 
-    def __init__(self, prefix='', hash=None):
+    BINARY_MAGIC = b'PMTRIE\x01\n'
+
+    # class-level defaults, only stored per node when set
+    dirty    = False
+    deferred = False
+    source   = None
+    merkle   = None
+    path     = None
+    vdigest  = None
+
+    def __init__(self, prefix='', hash=None, deferred=False):
         self.prefix = prefix
         self.hash   = hash if hash is not None else NULL_HASH
         self.size   = 0
         self.children = None
         self.key      = None
         self.value    = None 
+        if deferred:
+            self.deferred = True
+
+    @property
+    def hash(self):
+        if self.dirty:
+            self.commit()
+        return self._hash
+
+    @hash.setter
+    def hash(self, value):
+        self._hash = value
+
+    def is_stub(self):
+        return self.source is not None and self.children is None and self.key is None and self.path is None
 
     def get_type(self):
-        if self.key is not None and self.value is not None:
+        if self.source is not None:
+            if self.children is None and self.key is None and self.path is None:
+                self.source.resolve(self)
+            else:
+                self.source.touch(self)
+        if self.path is not None or (self.key is not None and self.value is not None):
             return PMtrie.TYPE_LEAF
         elif self.children is not None:
             return PMtrie.TYPE_BRANCH
@@ -37,6 +68,173 @@ class PMtrie:
             t.insert(d['key'], d['value'])
         return t
 
+    @staticmethod
+    def FromBulk(l):
+        entries = [(to_path(d['key']), d['key'], d['value']) for d in l]
+        entries.sort(key=lambda e: e[0])
+        return PMtrie.FromSorted(entries)
+
+    @staticmethod
+    def FromSorted(entries, depth=0):
+        # entries: iterable of (path, key, value) or (path, key, value, value
+        # digest) in ascending path order, all sharing path[:depth]; the result is the subtrie below depth.
+        # Builds bottom-up with a stack of open branches, hashing every node once.
+        # A frame is [branch nibble index, any path below it, children, size].
+
+        def finalize(sub, start):
+            if type(sub) is tuple:
+                path, key, value = sub[:3]
+                return PMtrie.Leaf(path[start:], key, value, path=path, value_digest=sub[3] if len(sub) > 3 else None)
+            depth, path, children, size = sub
+            branch = PMtrie.Branch(path[start:depth], children)
+            branch.size = size
+            return branch
+
+        def attach(frame, sub):
+            path = sub[0] if type(sub) is tuple else sub[1]
+            frame[2][nibble(path[frame[0]])] = finalize(sub, frame[0] + 1)
+            frame[3] += 1 if type(sub) is tuple else sub[3]
+
+        stack = []
+        prev = None
+        for entry in entries:
+            if prev is not None:
+                if entry[0] <= prev[0]:
+                    raise Exception("entries not sorted or duplicate key")
+                split = len(common_prefix(prev[0], entry[0]))
+                sub = prev
+                while len(stack) > 0 and stack[-1][0] > split:
+                    frame = stack.pop()
+                    attach(frame, sub)
+                    sub = frame
+                if len(stack) == 0 or stack[-1][0] < split:
+                    stack.append([split, entry[0], [None]*16, 0])
+                attach(stack[-1], sub)
+            prev = entry
+
+        if prev is None:
+            return PMtrie()
+
+        sub = prev
+        while len(stack) > 0:
+            frame = stack.pop()
+            attach(frame, sub)
+            sub = frame
+        return finalize(sub, depth)
+
+    @staticmethod
+    def FromProofs(proofs):
+        # sparse trie holding only what the proofs carry, all against the same
+        # root. Siblings known by their hash alone are stubs that raise when
+        # reached, children hidden in a merkle neighbor have no hash at all.
+        # Keys proven with their value can be updated; a proof without value
+        # (the verify(False) reading) describes the trie without its key, so
+        # the key can then be inserted. A delete that would collapse a branch
+        # into a child the proofs don't cover raises.
+        uncovered = Uncovered()
+
+        def stub(h):
+            node = PMtrie.Stub(NULL_HASH, uncovered)
+            node.hash = h
+            return node
+
+        def sparse(prefix, root=None):
+            node = PMtrie(prefix=prefix)
+            node.children = [stub(None) for _ in range(16)]
+            node.merkle = [[None]*(16 >> depth) for depth in range(5)]
+            if root is not None:
+                node.merkle[4][0] = root
+                node.hash = PMtrie.ComputeHash(prefix, root=root)
+            else:
+                node.dirty = True
+            return node
+
+        def known(node):
+            return node is not None and not node.is_stub()
+
+        def neighbor_node(step, pos):
+            # the other child of a fork or leaf step whose branch nibble is at pos
+            neighbor = step['neighbor']
+            if step['type'] == PMproof.TYPE_LEAF:
+                path = neighbor['key']
+                return nibble(path[pos]), PMtrie.Leaf(path[pos+1:], None, None, path=path, value_digest=neighbor['value'])
+            return neighbor['nibble'], sparse(''.join('%x' % b for b in neighbor['prefix']), neighbor['root'])
+
+        def fill(node, step, me, pos):
+            if step['type'] == PMproof.TYPE_BRANCH:
+                if node.merkle is None:
+                    return
+                for depth, h in zip((3, 2, 1, 0), step['neighbors']):
+                    i = (me >> depth) ^ 1
+                    node.merkle[depth][i] = h
+                    if h == EMPTY_HASHES[depth]:
+                        for j in range(i << depth, (i + 1) << depth):
+                            node.children[j] = None
+                            node.merkle[0][j] = NULL_HASH
+                    elif depth == 0 and not known(node.children[i]):
+                        node.children[i] = stub(h)
+                # another proof may have filled in our child as its neighbor,
+                # clearing it makes compute_root hash our path up to the root
+                node.merkle[0][me] = None
+            else:
+                j, neighbor = neighbor_node(step, pos)
+                for i in range(16):
+                    if i == j:
+                        if not known(node.children[i]):
+                            node.children[i] = neighbor
+                    elif i != me:
+                        node.children[i] = None
+                node.merkle = None
+                node.dirty = True
+
+        root = None
+        parent, slot = None, None
+
+        def attach(new):
+            nonlocal root
+            if parent is None:
+                root = new
+            else:
+                parent.children[slot] = new
+
+        for proof in proofs:
+            path = proof.path
+            parent, slot = None, None
+            node = root
+            cursor = 0
+            for ix, step in enumerate(proof.steps):
+                skip = step['skip']
+                me = nibble(path[cursor+skip])
+
+                if proof.value is None and ix == len(proof.steps) - 1 and step['type'] != PMproof.TYPE_BRANCH:
+                    # without the item its branch collapses into the neighbor
+                    if not known(node):
+                        j, neighbor = neighbor_node(step, cursor + skip)
+                        if step['type'] == PMproof.TYPE_LEAF:
+                            attach(PMtrie.Leaf(neighbor.path[cursor:], None, None, path=neighbor.path, value_digest=neighbor.vdigest))
+                        else:
+                            attach(sparse(path[cursor:cursor+skip] + '%x' % j + neighbor.prefix, step['neighbor']['root']))
+                    break
+
+                if not known(node):
+                    node = sparse(path[cursor:cursor+skip])
+                    attach(node)
+                elif node.children is None or node.prefix != path[cursor:cursor+skip]:
+                    raise Exception("proofs disagree")
+                fill(node, step, me, cursor + skip)
+
+                parent, slot = node, me
+                node = node.children[me]
+                cursor += skip + 1
+            else:
+                if proof.value is not None:
+                    if not known(node):
+                        attach(PMtrie.Leaf(path[cursor:], None, proof.value, path=path))
+                elif len(proof.steps) > 0:
+                    attach(None)
+
+        return root if root is not None else PMtrie()
+
     @staticmethod
     def ComputeHash(prefix:str, value=None, root=None):
 
@@ -53,20 +251,54 @@ class PMtrie:
 
 
     @staticmethod
-    def Leaf(prefix:str, key, value):
-        d_hex = hexdigest(encode_string(key))
+    def Leaf(prefix:str, key, value, path=None, value_digest=None):
+        # with path and value_digest given, key and value are optional and
+        # only kept, the leaf hash needs nothing else
+        d_hex = path if path is not None else to_path(key)
         assert d_hex.endswith(prefix)
 
         leaf = PMtrie()
-        leaf.hash   = PMtrie.ComputeHash(prefix, value=digest(encode_string(value)))
-        leaf.prefix = prefix
-        leaf.key    = encode_string(key)
-        leaf.value  = encode_string(value)
+        leaf.key     = encode_string(key) if key is not None else None
+        leaf.value   = encode_string(value) if value is not None else None
+        leaf.path    = d_hex
+        leaf.vdigest = value_digest if value_digest is not None else digest(leaf.value)
+        leaf.hash    = PMtrie.ComputeHash(prefix, value=leaf.vdigest)
+        leaf.size    = 1
+        leaf.prefix  = prefix
 
         return leaf
 
+    def leaf_path(self):
+        if self.path is None:
+            self.path = to_path(self.key)
+        return self.path
+
+    def value_digest(self):
+        if self.vdigest is None:
+            self.vdigest = digest(self.value)
+        return self.vdigest
+
+    def stored_value(self):
+        # a leaf from insert_prehashed may only hold the digest of its value
+        if self.value is None:
+            raise Exception(f"no value stored for {self.leaf_path()}, only its digest")
+        return self.value
+
+    def stored_key(self):
+        if self.key is None:
+            raise Exception(f"no key stored for {self.leaf_path()}, only its path")
+        return self.key
+
     @staticmethod
-    def Branch(prefix:str, children):
+    def Stub(hash, source, ref=None):
+        stub = PMtrie(hash=hash)
+        stub.source = source
+        if ref is not None:
+            stub.ref = ref
+        return stub
+
+    @staticmethod
+    def Branch(prefix:str, children, deferred=False):
         branch = PMtrie()
         branch.prefix = prefix
         if type(children) is list:
@@ -80,11 +312,20 @@ class PMtrie:
         branch.size = sum([(1 if x is not None else 0) for x in branch.children])
         assert branch.size > 1
 
-        branch.hash = PMtrie.ComputeHash(prefix, root=merkle_root(branch.children))
+        if deferred:
+            branch.dirty = True
+        else:
+            branch.hash = PMtrie.ComputeHash(prefix, root=branch.compute_root())
         return branch
     
     def replace_with(self, new):
+        deferred = self.deferred
+        source = self.source
         self.__dict__ = new.__dict__
+        if deferred:
+            self.deferred = True
+        if source is not None:
+            self.source = source
 
     def insert_digest(self, value):
         if type(value) is str:
@@ -93,27 +334,24 @@ class PMtrie:
             self.insert(digest(value), value)
 
     def insert(self, key, value):
+        return self.insert_prehashed(to_path(key), value, key=key)
+
+    def insert_prehashed(self, full_path, value, key=None, value_digest=None):
+        # full_path is the digest of the key (32 bytes or hex) and value_digest
+        # the digest of the value, e.g. from an indexer that already has them;
+        # key and value may be left out then and are only stored when given
+        if type(full_path) is bytes:
+            full_path = full_path.hex()
+        assert len(full_path) == 2*DIGEST_LENGTH
+        if value is None and value_digest is None:
+            raise Exception("value or value digest required")
 
         if self.get_type() == PMtrie.TYPE_ROOT:
-            self.replace_with(PMtrie.Leaf(to_path(key), key, value))
+            self.replace_with(PMtrie.Leaf(full_path, key, value, path=full_path, value_digest=value_digest))
 
         elif self.get_type() == PMtrie.TYPE_LEAF:
-            assert key != self.key
-            assert len(self.prefix) > 0
-
-            new_path = to_path(key)[-len(self.prefix):]
-
-            prefix = common_prefix(self.prefix, new_path)
+            self.split_leaf(full_path, key, value, value_digest)
 
-            this_nibble = nibble(self.prefix[len(prefix)])
-            new_nibble  = nibble(new_path[len(prefix)])
-
-            assert this_nibble != new_nibble
-
-            leaf_l = PMtrie.Leaf(self.prefix[len(prefix)+1:], self.key, self.value)
-            leaf_r = PMtrie.Leaf(new_path[len(prefix)+1:], key, value)
-
-            self.replace_with(PMtrie.Branch(prefix, {this_nibble: leaf_l, new_nibble: leaf_r}))
         else:
 
             def loop(node, path, parents):
@@ -127,33 +365,430 @@ class PMtrie:
 
                     assert new_nibble != this_nibble
 
-                    leaf_l   = PMtrie.Leaf(path[1:], key, value)
-                    branch_r = PMtrie.Branch(node.prefix[len(prefix)+1:],  node.children)
+                    leaf_l   = PMtrie.Leaf(path[1:], key, value, path=full_path, value_digest=value_digest)
+                    branch_r = PMtrie.Branch(node.prefix[len(prefix)+1:],  node.children, deferred=True)
+                    branch_r.size = node.size
+                    branch_r.merkle = node.merkle
 
-                    node.replace_with(PMtrie.Branch(prefix, {this_nibble: leaf_l, new_nibble: branch_r}))
+                    node.replace_with(PMtrie.Branch(prefix, {this_nibble: leaf_l, new_nibble: branch_r}, deferred=True))
+                    node.size = branch_r.size + 1
                     return parents
 
-                parents.insert(0, node)
+                parents.append(node)
 
                 child = node.children[this_nibble]
                 if child is None:
-                    node.children[this_nibble] = PMtrie.Leaf(path[1:], key, value)
-                    node.hash = PMtrie.ComputeHash(node.prefix, root=merkle_root(node.children))
+                    node.children[this_nibble] = PMtrie.Leaf(path[1:], key, value, path=full_path, value_digest=value_digest)
                     return parents
 
                 if child.get_type() == PMtrie.TYPE_LEAF:
-                    child.insert(key, value)
-                    node.hash = PMtrie.ComputeHash(node.prefix, root=merkle_root(node.children))
+                    child.split_leaf(full_path, key, value, value_digest)
                     return parents
                 else:
                     return loop(child, path[1:], parents)
 
-            parents = loop(self, to_path(key), [])
+            parents = loop(self, full_path, [])
             for p in parents:
                 p.size += 1
-                if p.get_type() == PMtrie.TYPE_BRANCH:
-                    p.hash = PMtrie.ComputeHash(p.prefix, root=merkle_root(p.children))
-            return self
+                p.dirty = True
+
+        if not self.deferred:
+            self.commit()
+        if self.source is not None:
+            self.source.trim()
+        return self
+
+    def split_leaf(self, full_path, key, value, value_digest=None):
+        assert len(self.prefix) > 0
+
+        new_path = full_path[-len(self.prefix):]
+        if new_path == self.prefix:
+            raise Exception("key already in trie")
+
+        prefix = common_prefix(self.prefix, new_path)
+
+        this_nibble = nibble(self.prefix[len(prefix)])
+        new_nibble  = nibble(new_path[len(prefix)])
+
+        assert this_nibble != new_nibble
+
+        leaf_l = PMtrie.Leaf(self.prefix[len(prefix)+1:], self.key, self.value, path=self.leaf_path(), value_digest=self.value_digest())
+        leaf_r = PMtrie.Leaf(new_path[len(prefix)+1:], key, value, path=full_path, value_digest=value_digest)
+
+        self.replace_with(PMtrie.Branch(prefix, {this_nibble: leaf_l, new_nibble: leaf_r}, deferred=True))
+
+    def locate(self, path):
+        # follows path down the trie, returns the branches passed as (node, nibble)
+        # and the leaf at the end of it, or None if path is not in the trie
+        trail = []
+        node = self
+        while True:
+            node_type = node.get_type()
+            if node_type == PMtrie.TYPE_ROOT or not path.startswith(node.prefix):
+                return trail, None
+            if node_type == PMtrie.TYPE_LEAF:
+                return trail, (node if path == node.prefix else None)
+            path = path[len(node.prefix):]
+            branch = nibble(path[0])
+            trail.append((node, branch))
+            node = node.children[branch]
+            if node is None:
+                return trail, None
+            path = path[1:]
+
+    def get(self, key, default=None):
+        # value stored under key, only the key is hashed on the way down
+        _, leaf = self.locate(to_path(key))
+        value = leaf.stored_value() if leaf is not None else default
+        if self.source is not None:
+            self.source.trim()
+        return value
+
+    def contains(self, key):
+        _, leaf = self.locate(to_path(key))
+        if self.source is not None:
+            self.source.trim()
+        return leaf is not None
+
+    def get_many(self, keys, default=None):
+        values = []
+        for key in keys:
+            _, leaf = self.locate(to_path(key))
+            values.append(leaf.stored_value() if leaf is not None else default)
+        if self.source is not None:
+            self.source.trim()
+        return values
+
+    def update(self, key, value):
+        trail, leaf = self.locate(to_path(key))
+        if leaf is None:
+            raise Exception("key not in trie")
+        self.update_leaf(trail, leaf, value)
+
+        if not self.deferred:
+            self.commit()
+        if self.source is not None:
+            self.source.trim()
+        return self
+
+    def update_leaf(self, trail, leaf, value):
+        # trail and leaf as returned by locate; leaves the branches dirty
+        leaf.value   = encode_string(value)
+        leaf.vdigest = digest(leaf.value)
+        leaf.hash    = PMtrie.ComputeHash(leaf.prefix, value=leaf.vdigest)
+        for node, _ in trail:
+            node.dirty = True
+
+    def delete(self, key):
+        trail, leaf = self.locate(to_path(key))
+        if leaf is None:
+            raise Exception("key not in trie")
+        self.delete_leaf(trail, leaf)
+
+        if not self.deferred:
+            self.commit()
+        if self.source is not None:
+            self.source.trim()
+        return self
+
+    def delete_leaf(self, trail, leaf):
+        # trail and leaf as returned by locate; leaves the branches dirty
+        if len(trail) == 0:
+            deferred = self.deferred
+            self.__dict__ = PMtrie().__dict__
+            if deferred:
+                self.deferred = True
+            return
+
+        parent, branch = trail[-1]
+        remaining = [(i, child) for i, child in enumerate(parent.children) if child is not None and i != branch]
+        # in a trie from FromProofs, children hidden in a merkle neighbor have
+        # no hash; at least one of them is real, but not which or how many
+        hidden = [i for i, child in remaining if child.is_stub() and child._hash is None]
+        remaining = [(i, child) for i, child in remaining if i not in hidden]
+        if len(remaining) == 0:
+            raise Exception("not covered by the proofs")
+        if len(remaining) == 1 and len(hidden) == 0:
+            # resolved before anything changes, so an uncovered stub raises here
+            remaining[0][1].get_type()
+
+        for node, _ in trail:
+            node.size -= 1
+            node.dirty = True
+        parent.children[branch] = None
+
+        if len(remaining) == 1 and len(hidden) == 0:
+            i, child = remaining[0]
+            parent.replace_with(child.with_prefix(parent.prefix + '%x' % i + child.prefix, deferred=True))
+
+    def proof_at(self, path):
+        # proof of the leaf at path from the cached merkle levels on the way
+        # down, without rehashing anything on a committed trie
+        trail, leaf = self.locate(path)
+        if leaf is None:
+            raise Exception("key not in trie")
+        proof = PMproof.FromTrail(path, trail, leaf)
+        if self.source is not None:
+            self.source.trim()
+        return proof
+
+    # state transitions: each returns (proof, old root, new root). The proof is
+    # of the key in whichever trie holds it, verify() gives that root and
+    # verify(False) the one without the key. Update and delete take the proof
+    # from the trail of their own descent; insert restructures the path, so
+    # its proof comes from a second descent, which hashes nothing.
+
+    def insert_with_proof(self, key, value):
+        old_root = self.commit()
+        path = to_path(key)
+        self.insert_prehashed(path, value, key=key)
+        new_root = self.commit()
+        return self.proof_at(path), old_root, new_root
+
+    def update_with_proof(self, key, value):
+        # the proof holds the new value; with the old value it verifies to old root
+        old_root = self.commit()
+        path = to_path(key)
+        trail, leaf = self.locate(path)
+        if leaf is None:
+            raise Exception("key not in trie")
+        self.update_leaf(trail, leaf, value)
+        new_root = self.commit()
+        proof = PMproof.FromTrail(path, trail, leaf)
+        if self.source is not None:
+            self.source.trim()
+        return proof, old_root, new_root
+
+    def delete_with_proof(self, key):
+        old_root = self.commit()
+        path = to_path(key)
+        trail, leaf = self.locate(path)
+        if leaf is None:
+            raise Exception("key not in trie")
+        proof = PMproof.FromTrail(path, trail, leaf)
+        self.delete_leaf(trail, leaf)
+        new_root = self.commit()
+        if self.source is not None:
+            self.source.trim()
+        return proof, old_root, new_root
+
+    def apply_with_proofs(self, changes):
+        # changes: ('insert', key, value), ('update', key, value) or ('delete', key);
+        # the transitions are chained, every old root is the previous new root
+        ops = {
+            'insert': self.insert_with_proof,
+            'update': self.update_with_proof,
+            'delete': self.delete_with_proof,
+            }
+        return [ops[change[0]](*change[1:]) for change in changes]
+
+    def leaves(self):
+        node_type = self.get_type()
+        if node_type == PMtrie.TYPE_LEAF:
+            yield self
+        elif node_type == PMtrie.TYPE_BRANCH:
+            for child in self.children:
+                if child is not None:
+                    yield from child.leaves()
+
+    def scan(self, prefix=''):
+        # leaves whose path starts with the hex prefix, in path order
+        node = self
+        while True:
+            node_type = node.get_type()
+            if node_type == PMtrie.TYPE_ROOT:
+                return
+            if len(prefix) <= len(node.prefix) or node_type == PMtrie.TYPE_LEAF:
+                if node.prefix.startswith(prefix):
+                    yield from node.leaves()
+                return
+            if not prefix.startswith(node.prefix):
+                return
+            prefix = prefix[len(node.prefix):]
+            node = node.children[nibble(prefix[0])]
+            if node is None:
+                return
+            prefix = prefix[1:]
+
+    def items(self, prefix=''):
+        for leaf in self.scan(prefix):
+            yield leaf.stored_key(), leaf.stored_value()
+
+    def keys(self, prefix=''):
+        for leaf in self.scan(prefix):
+            yield leaf.stored_key()
+
+    def export_ndjson(self, f):
+        for k, v in self.items():
+            f.write(json.dumps({'key': k.hex(), 'value': v.hex()}) + '\n')
+
+    def export_binary(self, f):
+        f.write(PMtrie.BINARY_MAGIC)
+        for k, v in self.items():
+            f.write(struct.pack('>I', len(k)) + k + struct.pack('>I', len(v)) + v)
+
+    def save(self, path):
+        from image import save_image
+        save_image(self, path)
+
+    @staticmethod
+    def open(path, capacity=100000):
+        from image import open_image
+        return open_image(path, capacity)
+
+    @staticmethod
+    def FromStream(records, presorted=True):
+        # records: iterable of (key, value); exports are in path order and
+        # load with a bounded stack, anything else goes through insert
+        if presorted:
+            return PMtrie.FromSorted((to_path(k), k, v) for k, v in records)
+        t = PMtrie()
+        for k, v in records:
+            t.insert(k, v)
+        return t
+
+    @staticmethod
+    def FromNDJSON(f, presorted=True):
+        def records():
+            for line in f:
+                if line.strip():
+                    d = json.loads(line)
+                    yield bytes.fromhex(d['key']), bytes.fromhex(d['value'])
+        return PMtrie.FromStream(records(), presorted)
+
+    @staticmethod
+    def FromBinary(f, presorted=True):
+        if f.read(len(PMtrie.BINARY_MAGIC)) != PMtrie.BINARY_MAGIC:
+            raise Exception("not a trie export")
+
+        def records():
+            while True:
+                head = f.read(4)
+                if len(head) == 0:
+                    return
+                k = f.read(struct.unpack('>I', head)[0])
+                v = f.read(struct.unpack('>I', f.read(4))[0])
+                yield k, v
+        return PMtrie.FromStream(records(), presorted)
+
+    def diff(self, other):
+        # yields ('added', key, value), ('removed', key, value) and
+        # ('changed', key, old, new) to go from self to other, skipping every
+        # subtree whose hash is the same on both sides
+        self.commit()
+        other.commit()
+
+        def removed(node):
+            for leaf in node.leaves():
+                yield ('removed', leaf.key, leaf.value)
+
+        def added(node):
+            for leaf in node.leaves():
+                yield ('added', leaf.key, leaf.value)
+
+        def leaf_against(leaf, node, leaf_is_old):
+            found = False
+            for other_leaf in node.leaves():
+                if other_leaf.leaf_path() == leaf.leaf_path():
+                    found = True
+                    if other_leaf.value_digest() != leaf.value_digest():
+                        if leaf_is_old:
+                            yield ('changed', leaf.key, leaf.value, other_leaf.value)
+                        else:
+                            yield ('changed', leaf.key, other_leaf.value, leaf.value)
+                else:
+                    yield ('added', other_leaf.key, other_leaf.value) if leaf_is_old else ('removed', other_leaf.key, other_leaf.value)
+            if not found:
+                yield ('removed', leaf.key, leaf.value) if leaf_is_old else ('added', leaf.key, leaf.value)
+
+        # a and b start at the same position in the path, offset is how much
+        # of their prefix was already matched above
+        def loop(a, offset_a, b, offset_b):
+            if a is None or a.get_type() == PMtrie.TYPE_ROOT:
+                if b is not None:
+                    yield from added(b)
+                return
+            if b is None or b.get_type() == PMtrie.TYPE_ROOT:
+                yield from removed(a)
+                return
+            if offset_a == 0 and offset_b == 0 and a.hash == b.hash:
+                return
+
+            if a.get_type() == PMtrie.TYPE_LEAF:
+                yield from leaf_against(a, b, True)
+                return
+            if b.get_type() == PMtrie.TYPE_LEAF:
+                yield from leaf_against(b, a, False)
+                return
+
+            prefix_a = a.prefix[offset_a:]
+            prefix_b = b.prefix[offset_b:]
+            if prefix_a == prefix_b:
+                for i in range(16):
+                    yield from loop(a.children[i], 0, b.children[i], 0)
+                return
+
+            n = len(common_prefix(prefix_a, prefix_b))
+            if n < len(prefix_a) and n < len(prefix_b):
+                yield from removed(a)
+                yield from added(b)
+            elif n == len(prefix_a):
+                below = nibble(prefix_b[n])
+                for i in range(16):
+                    if i == below:
+                        yield from loop(a.children[i], 0, b, offset_b + n + 1)
+                    elif a.children[i] is not None:
+                        yield from removed(a.children[i])
+            else:
+                below = nibble(prefix_a[n])
+                for i in range(16):
+                    if i == below:
+                        yield from loop(a, offset_a + n + 1, b.children[i], 0)
+                    elif b.children[i] is not None:
+                        yield from added(b.children[i])
+
+        yield from loop(self, 0, other, 0)
+
+    def _copy_node(self):
+        # copies this node alone, its children stay shared with the original;
+        # for path copying in PMhistory, not a copy of the trie
+        node = PMtrie()
+        node.__dict__.update(self.__dict__)
+        if self.children is not None:
+            node.children = list(self.children)
+        if self.merkle is not None:
+            node.merkle = [list(level) for level in self.merkle]
+        return node
+
+    def with_prefix(self, prefix, deferred=False):
+        if self.get_type() == PMtrie.TYPE_LEAF:
+            return PMtrie.Leaf(prefix, self.key, self.value, path=self.leaf_path(), value_digest=self.value_digest())
+        branch = PMtrie.Branch(prefix, list(self.children), deferred=True)
+        branch.size = self.size
+        if self.merkle is not None:
+            branch.merkle = [list(level) for level in self.merkle]
+        if not deferred:
+            branch.commit()
+        return branch
+
+    def commit(self):
+        if self.dirty:
+            self.dirty = False
+            self.hash = PMtrie.ComputeHash(self.prefix, root=self.compute_root())
+        return self._hash
+
+    def compute_root(self):
+        # merkle root of the children, keeping every level cached on the branch
+        # so a changed child costs the 4 hashes above it
+        if self.merkle is None:
+            self.merkle = merkle_levels(self.children)
+        else:
+            leaves = self.merkle[0]
+            for i, child in enumerate(self.children):
+                h = child.hash if child is not None else NULL_HASH
+                if h != leaves[i]:
+                    merkle_update(self.merkle, i, h)
+        return self.merkle[4][0]
 
     def prove_digest(self, value):
         if type(value) is str:
@@ -163,14 +798,18 @@ class PMtrie:
         return self.prove(key)
 
     def prove(self, key):
-        return self.walk(to_path(key))
+        self.commit()
+        proof = self.walk(to_path(key))
+        if self.source is not None:
+            self.source.trim()
+        return proof
 
     def walk(self, path):
         if self.get_type() == PMtrie.TYPE_ROOT:
             raise Exception("can't do this")
         elif self.get_type() == PMtrie.TYPE_LEAF:
             assert path.startswith(self.prefix)
-            return PMproof(to_path(self.key), self.value if path == self.prefix else None)
+            return PMproof(self.leaf_path(), self.value if path == self.prefix else None)
         else:
             assert path.startswith(self.prefix)
             skip = len(self.prefix)
@@ -183,7 +822,70 @@ class PMtrie:
             assert child is not None
             proof = child.walk(path[1:])
 
-            return proof.rewind(child, skip, self.children)
+            proof.steps.insert(0, self.proof_step(branch))
+            return proof
+
+    def proof_step(self, me):
+        # the proof step through this branch towards the child at nibble me
+        skip = len(self.prefix)
+        others = [(i, child) for i, child in enumerate(self.children) if child is not None and i != me]
+        if len(others) == 1:
+            i, neighbor = others[0]
+            if neighbor.get_type() == PMtrie.TYPE_LEAF:
+                return {
+                    'type': PMproof.TYPE_LEAF,
+                    'skip': skip,
+                    'neighbor': {
+                        'key': neighbor.leaf_path(),
+                        'value': neighbor.value_digest(),
+                        }
+                    }
+            return {
+                'type': PMproof.TYPE_FORK,
+                'skip': skip,
+                'neighbor': {
+                    'prefix': nibbles(neighbor.prefix),
+                    'nibble': i,
+                    'root': neighbor.compute_root(),
+                    }
+                }
+        self.compute_root()
+        return {
+            'type': PMproof.TYPE_BRANCH,
+            'skip': skip,
+            'neighbors': merkle_neighbors(self.merkle, me),
+            }
+
+    def prove_many(self, keys):
+        # proofs for all keys from one traversal in path order; proofs of keys
+        # below the same child share that step
+        self.commit()
+        paths = [to_path(key) for key in keys]
+        proofs = [None]*len(keys)
+
+        def loop(node, members, steps):
+            if node.get_type() != PMtrie.TYPE_BRANCH:
+                for i, path in members:
+                    proofs[i] = node.walk(path)
+                    proofs[i].steps = steps + proofs[i].steps
+                return
+
+            skip = len(node.prefix)
+            groups = {}
+            for i, path in members:
+                assert path.startswith(node.prefix)
+                groups.setdefault(nibble(path[skip]), []).append((i, path[skip+1:]))
+
+            for branch in sorted(groups):
+                child = node.children[branch]
+                assert child is not None
+                loop(child, groups[branch], steps + [node.proof_step(branch)])
+
+        if len(keys) > 0:
+            loop(self, list(enumerate(paths)), [])
+        if self.source is not None:
+            self.source.trim()
+        return proofs
 
 
 
@@ -206,49 +908,44 @@ class PMproof:
         self.value = value
         self.steps = []
 
-    def rewind(self, target, skip, children):
+    @staticmethod
+    def FromTrail(path, trail, leaf):
+        # trail and leaf as returned by PMtrie.locate, on a committed trie
+        proof = PMproof(path, leaf.value)
+        proof.steps = [node.proof_step(branch) for node, branch in trail]
+        return proof
 
-        me = None
-        nodes = []
-        for i,child in enumerate(children):
-            if child is not None:
-                if child.hash == target.hash:
-                    me = i
+    @staticmethod
+    def step_root(step, path, cursor, me):
+        # hash of the branch described by step, given the hash of its child on path
+        next_cursor = cursor + 1 + step['skip']
+        prefix = path[cursor:next_cursor-1]
+        this_nibble = nibble(path[next_cursor-1])
+
+        if step['type'] == PMproof.TYPE_BRANCH:
+            merkle = me
+            for depth, neighbor in enumerate(reversed(step['neighbors'])):
+                if (this_nibble >> depth) & 1:
+                    merkle = digest(neighbor + merkle)
                 else:
-                    nodes.append(child)
+                    merkle = digest(merkle + neighbor)
+            return PMtrie.ComputeHash(prefix, root=merkle)
 
-        if me is None:
-            raise Exception("target not in children")
+        elif step['type'] == PMproof.TYPE_FORK:
+            neighbor = step['neighbor']
+            assert neighbor['nibble'] != this_nibble
+            other = digest(neighbor['prefix'] + neighbor['root'])
+            return PMtrie.ComputeHash(prefix, root=merkle_root(sparse_vector({this_nibble: me, neighbor['nibble']: other})))
 
-        if (len(nodes) == 1):
-            neighbor = nodes[0]
-            if neighbor.get_type() == PMtrie.TYPE_LEAF:
-                self.steps.insert(0, {
-                    'type': PMproof.TYPE_LEAF,
-                    'skip': skip,
-                    'neighbor': {
-                        'key': to_path(neighbor.key),
-                        'value': digest(neighbor.value),
-                        }
-                    })
-            else:
-                self.steps.insert(0, {
-                    'type': PMproof.TYPE_FORK,
-                    'skip': skip,
-                    'neighbor': {
-                        'prefix': nibbles(neighbor.prefix),
-                        'nibble': children.index(neighbor),
-                        'root': merkle_root(neighbor.children),
-                        }
-                    })
-        else:
-            self.steps.insert(0, {
-                'type': PMproof.TYPE_BRANCH,
-                'skip': skip,
-                'neighbors': merkle_proof(children, me),
-                })
+        elif step['type'] == PMproof.TYPE_LEAF:
+            neighbor_path = step['neighbor']['key']
+            assert neighbor_path[:cursor] == path[:cursor]
+            neighbor_nibble = nibble(neighbor_path[next_cursor-1])
+            assert neighbor_nibble != this_nibble
+            other = PMtrie.ComputeHash(neighbor_path[next_cursor:], value=step['neighbor']['value'])
+            return PMtrie.ComputeHash(prefix, root=merkle_root(sparse_vector({this_nibble: me, neighbor_nibble: other})))
 
-        return self
+        raise Exception("unknown proof type")
 
     def verify(self, including_item=True):
         if not including_item and len(self.steps) == 0:
@@ -334,7 +1031,7 @@ class PMproof:
         if step['type'] == PMproof.TYPE_BRANCH:
             return dict(step, neighbors=''.join([x.hex() for x in step['neighbors'] if x is not None]))
         elif step['type'] == PMproof.TYPE_FORK:
-            return dict(step, neighbor=dict(step['neighbor'], prefix=step['neighbor']['prefix'], root=step['neighbor']['root'].hex()))
+            return dict(step, neighbor=dict(step['neighbor'], prefix=step['neighbor']['prefix'].hex(), root=step['neighbor']['root'].hex()))
         elif step['type'] == PMproof.TYPE_LEAF:
             return dict(step, neighbor={'key': step['neighbor']['key'], 'value': step['neighbor']['value'].hex()})
 
@@ -355,39 +1052,152 @@ class PMproof:
                 result.append([2, step['skip'], step['neighbor']['key'], step['neighbor']['value'].hex()])
         return result
 
-    def toCBOR(self):
-        cbor = '9f'
+    @staticmethod
+    def cbor_step_size(step):
+        skip = len(cbor_head(0, step['skip']))
+        if step['type'] == PMproof.TYPE_BRANCH:
+            return 3 + skip + 1 + 2 + 64 + 2 + 64 + 2
+        elif step['type'] == PMproof.TYPE_FORK:
+            prefix = len(step['neighbor']['prefix'])
+            return 3 + skip + 3 + 1 + (1 if prefix < 16 else 2) + prefix + 2 + DIGEST_LENGTH + 2
+        elif step['type'] == PMproof.TYPE_LEAF:
+            return 3 + skip + 2 + DIGEST_LENGTH + 2 + DIGEST_LENGTH + 1
+        raise Exception("unknown proof type")
+
+    @staticmethod
+    def write_cbor_step(buf, pos, step):
+        # writes one step into buf at pos, returns the position after it
+
+        def put(b):
+            nonlocal pos
+            buf[pos:pos+len(b)] = b
+            pos += len(b)
+
+        if step['type'] == PMproof.TYPE_BRANCH:
+            neighbors = b''.join([x for x in step['neighbors'] if x is not None])
+            put(b'\xd8\x79\x9f')
+            put(cbor_head(0, step['skip']))
+            put(b'\x5f\x58\x40')
+            put(neighbors[:64])
+            put(b'\x58\x40')
+            put(neighbors[64:])
+            put(b'\xff\xff')
+        elif step['type'] == PMproof.TYPE_FORK:
+            neighbor = step['neighbor']
+            prefix = neighbor['prefix']
+            put(b'\xd8\x7a\x9f')
+            put(cbor_head(0, step['skip']))
+            put(b'\xd8\x79\x9f')
+            put(cbor_head(0, neighbor['nibble']))
+            put(bytes([0x40 + len(prefix)]) if len(prefix) < 16 else bytes([0x58, len(prefix)]))
+            put(prefix)
+            put(b'\x58\x20')
+            put(neighbor['root'])
+            put(b'\xff\xff')
+        elif step['type'] == PMproof.TYPE_LEAF:
+            put(b'\xd8\x7b\x9f')
+            put(cbor_head(0, step['skip']))
+            put(b'\x58\x20')
+            put(bytes.fromhex(step['neighbor']['key']))
+            put(b'\x58\x20')
+            put(step['neighbor']['value'])
+            put(b'\xff')
+        return pos
+
+    def toCBORbytes(self):
+        buf = bytearray(2 + sum(PMproof.cbor_step_size(step) for step in self.steps))
+        buf[0] = 0x9f
+        pos = 1
         for step in self.steps:
-            if step['type'] == PMproof.TYPE_BRANCH:
-                neighbors = ''.join([x.hex() for x in step['neighbors'] if x is not None])
-                cbor += 'd8799f' + bytes([step['skip']]).hex() + '5f' + '5840' + neighbors[:128] + '5840' + neighbors[128:] + 'ffff' 
-            elif step['type'] == PMproof.TYPE_FORK:
-                if len(step['neighbor']['prefix']) < 16:
-                    _prefix = bytes([0x40 + len(step['neighbor']['prefix'])]).hex() + step['neighbor']['prefix'].hex()
-                else:
-                    _prefix = '58' + bytes([len(step['neighbor']['prefix'])]).hex() + step['neighbor']['prefix'].hex()
-                cbor += 'd87a9f' + bytes([step['skip']]).hex() + 'd8799f' + bytes([step['neighbor']['nibble']]).hex() + _prefix  + '5820' + step['neighbor']['root'].hex() + 'ffff'
-            elif step['type'] == PMproof.TYPE_LEAF:
-                cbor += 'd87b9f' + bytes([step['skip']]).hex() + '5820' + step['neighbor']['key'] + '5820' + step['neighbor']['value'].hex() + 'ff'
-        cbor += 'ff'
-        return cbor
+            pos = PMproof.write_cbor_step(buf, pos, step)
+        buf[pos] = 0xff
+        return bytes(buf)
+
+    def toCBOR(self):
+        return self.toCBORbytes().hex()
 
     def toCBORlist(self):
         cbor = []
         for step in self.steps:
-            if step['type'] == PMproof.TYPE_BRANCH:
-                neighbors = ''.join([x.hex() for x in step['neighbors'] if x is not None])
-                cbor.append('d8799f' + bytes([step['skip']]).hex() + '5f' + '5840' + neighbors[:128] + '5840' + neighbors[128:] + 'ffff')
-            elif step['type'] == PMproof.TYPE_FORK:
-                if len(step['neighbor']['prefix']) < 16:
-                    _prefix = bytes([0x40 + len(step['neighbor']['prefix'])]).hex() + step['neighbor']['prefix'].hex()
-                else:
-                    _prefix = '58' + bytes([len(step['neighbor']['prefix'])]).hex() + step['neighbor']['prefix'].hex()
-                cbor.append('d87a9f' + bytes([step['skip']]).hex() + 'd8799f' + bytes([step['neighbor']['nibble']]).hex() + _prefix  + '5820' + step['neighbor']['root'].hex() + 'ffff')
-            elif step['type'] == PMproof.TYPE_LEAF:
-                cbor.append('d87b9f' + bytes([step['skip']]).hex() + '5820' + step['neighbor']['key'] + '5820' + step['neighbor']['value'].hex() + 'ff')
+            buf = bytearray(PMproof.cbor_step_size(step))
+            PMproof.write_cbor_step(buf, 0, step)
+            cbor.append(buf.hex())
         return cbor
 
+    @staticmethod
+    def fromCBOR(data, path='', value=None):
+        data = memoryview(data)
+        pos = 0
+
+        def expect(b):
+            nonlocal pos
+            if bytes(data[pos:pos+len(b)]) != b:
+                raise Exception(f"malformed proof at byte {pos}")
+            pos += len(b)
+
+        def uint():
+            nonlocal pos
+            n, pos = cbor_read_head(data, pos, 0)
+            return n
+
+        def bstr():
+            nonlocal pos
+            if data[pos] == 0x5f:
+                pos += 1
+                chunks = []
+                while data[pos] != 0xff:
+                    chunks.append(bstr())
+                pos += 1
+                return b''.join(chunks)
+            n, pos = cbor_read_head(data, pos, 2)
+            pos += n
+            return bytes(data[pos-n:pos])
+
+        proof = PMproof(path, value)
+        expect(b'\x9f')
+        while data[pos] != 0xff:
+            tag = bytes(data[pos:pos+3])
+            pos += 3
+            skip = uint()
+            if tag == b'\xd8\x79\x9f':
+                neighbors = bstr()
+                expect(b'\xff')
+                proof.steps.append({
+                    'type': PMproof.TYPE_BRANCH,
+                    'skip': skip,
+                    'neighbors': [neighbors[i:i+DIGEST_LENGTH] for i in range(0, len(neighbors), DIGEST_LENGTH)],
+                    })
+            elif tag == b'\xd8\x7a\x9f':
+                expect(b'\xd8\x79\x9f')
+                neighbor_nibble = uint()
+                prefix = bstr()
+                root = bstr()
+                expect(b'\xff\xff')
+                proof.steps.append({
+                    'type': PMproof.TYPE_FORK,
+                    'skip': skip,
+                    'neighbor': {
+                        'prefix': prefix,
+                        'nibble': neighbor_nibble,
+                        'root': root,
+                        }
+                    })
+            elif tag == b'\xd8\x7b\x9f':
+                neighbor_key = bstr()
+                neighbor_value = bstr()
+                expect(b'\xff')
+                proof.steps.append({
+                    'type': PMproof.TYPE_LEAF,
+                    'skip': skip,
+                    'neighbor': {
+                        'key': neighbor_key.hex(),
+                        'value': neighbor_value,
+                        }
+                    })
+            else:
+                raise Exception(f"unknown proof step at byte {pos-3}")
+        return proof
+
     @staticmethod
     def deserialize_step(d):
         if d['type'] == PMproof.TYPE_BRANCH:
@@ -396,6 +1206,7 @@ class PMproof:
             return dict(d, neighbors=neighbors)
         elif d['type'] == PMproof.TYPE_FORK:
             neighbor=d['neighbor']
+            neighbor['prefix'] = bytes.fromhex(neighbor['prefix'])
             neighbor['root'] = bytes.fromhex(neighbor['root'])
             return dict(d, neighbor=neighbor)
         elif d['type'] == PMproof.TYPE_LEAF:
@@ -421,6 +1232,96 @@ class PMproof:
             print(f"-[{i}]: {step['type']} @{step['skip']}")
 
 
+class PMmultiproof:
+    # proofs for several keys against one root, each distinct step stored once
+
+    def __init__(self):
+        self.steps  = []
+        self.proofs = []
+
+    @staticmethod
+    def step_key(step):
+        if step['type'] == PMproof.TYPE_BRANCH:
+            return (step['type'], step['skip'], tuple(step['neighbors']))
+        elif step['type'] == PMproof.TYPE_FORK:
+            n = step['neighbor']
+            return (step['type'], step['skip'], n['prefix'], n['nibble'], n['root'])
+        else:
+            n = step['neighbor']
+            return (step['type'], step['skip'], n['key'], n['value'])
+
+    @staticmethod
+    def FromProofs(proofs):
+        m = PMmultiproof()
+        index = {}
+        for proof in proofs:
+            ixs = []
+            for step in proof.steps:
+                k = PMmultiproof.step_key(step)
+                if k not in index:
+                    index[k] = len(m.steps)
+                    m.steps.append(step)
+                ixs.append(index[k])
+            m.proofs.append((proof.path, proof.value, ixs))
+        return m
+
+    def toProofs(self):
+        result = []
+        for path, value, ixs in self.proofs:
+            proof = PMproof(path, value)
+            proof.steps = [self.steps[i] for i in ixs]
+            result.append(proof)
+        return result
+
+    def verify(self):
+        # root hash all proofs lead to, or None if they disagree
+        memo = {}
+        roots = set()
+        for path, value, ixs in self.proofs:
+            cursors = [0]
+            for i in ixs:
+                cursors.append(cursors[-1] + 1 + self.steps[i]['skip'])
+            h = PMtrie.ComputeHash(path[cursors[-1]:], value=digest(encode_string(value)))
+            for i, cursor in reversed(list(zip(ixs, cursors))):
+                k = (i, cursor, h)
+                if k not in memo:
+                    memo[k] = PMproof.step_root(self.steps[i], path, cursor, h)
+                h = memo[k]
+            roots.add(h)
+        if len(roots) != 1:
+            return None
+        return roots.pop()
+
+    def toJSON(self):
+        p = PMproof('', None)
+        return json.dumps({
+            'steps': [p._serialize_step(step) for step in self.steps],
+            'proofs': [{'path': path, 'value': encode_string(value).hex(), 'steps': ixs} for path, value, ixs in self.proofs],
+            })
+
+    @staticmethod
+    def fromJSON(l):
+        d = json.loads(l)
+        m = PMmultiproof()
+        m.steps = [PMproof.deserialize_step(x) for x in d['steps']]
+        m.proofs = [(x['path'], bytes.fromhex(x['value']), x['steps']) for x in d['proofs']]
+        return m
+
+
+class Uncovered:
+    # source of the stubs in a trie built from proofs: they stand for
+    # subtrees the proofs only carry a hash of
+
+    def resolve(self, node):
+        raise Exception("not covered by the proofs")
+
+    def touch(self, node):
+        pass
+
+    def trim(self):
+        pass
+
+
 if __name__ == '__main__':
     t = PMtrie()
     t.insert('test','hello')
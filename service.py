@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Asyncio proof service speaking JSON lines over TCP or a Unix socket.
+# Proof requests arriving within a short window are answered from a single
+# prove_many traversal. The trie is only touched from one worker thread,
+# so writes and batched reads are serialized in arrival order, and
+# verification runs in a separate executor to keep the loop responsive.
+#
+# usage: python service.py serve [--port P | --unix PATH] [--load export.ndjson] [--window-ms W]
+#        python service.py load  [--port P | --unix PATH] [--clients C] [--requests R] [--keys K]
+#
+# requests, one JSON object per line, answered with {"id", "result"} or {"id", "error"}:
+#   {"id": 1, "op": "insert", "key": "apple", "value": "red"}    (also "update", "delete")
+#   {"id": 2, "op": "prove", "key": "apple", "format": "json"}   (or "cbor")
+#   {"id": 3, "op": "verify", "proof": <result of prove>}
+#   {"id": 4, "op": "root"}
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers import *
+from pmtrie import PMtrie, PMproof
+from verifier import proof_root
+
+def encode_proof(proof, fmt):
+    if fmt == 'cbor':
+        return {'path': proof.path, 'value': encode_string(proof.value).hex(), 'proof': proof.toCBOR()}
+    return json.loads(proof.toJSON(full=True))
+
+def decode_proof(d):
+    if 'proof' in d:
+        return PMproof.fromCBOR(bytes.fromhex(d['proof']), d['path'], bytes.fromhex(d['value']))
+    return PMproof.fromJSON(json.dumps(d))
+
+
+class PMservice:
+
+    def __init__(self, trie=None, window=0.002, max_batch=4096, verify_workers=None):
+        self.trie      = trie if trie is not None else PMtrie()
+        self.window    = window
+        self.max_batch = max_batch
+        self.writer    = ThreadPoolExecutor(max_workers=1)
+        self.verifier  = ThreadPoolExecutor(max_workers=verify_workers)
+        self.pending   = []
+        self.flushing  = None
+        self.root      = self.trie.hash
+        self.batches   = 0
+
+    def run(self, f, *args):
+        return asyncio.get_running_loop().run_in_executor(self.writer, f, *args)
+
+    def write(self, op, key, value=None):
+        if op == 'insert':
+            self.trie.insert(key, value)
+        elif op == 'update':
+            self.trie.update(key, value)
+        else:
+            self.trie.delete(key)
+        self.root = self.trie.hash
+        return self.root.hex()
+
+    def prove_batch(self, batch):
+        # one traversal for all keys; a failing key falls back to proving the
+        # batch one by one so it only fails its own request
+        keys = [key for key, _ in batch]
+        try:
+            proofs = self.trie.prove_many(keys)
+            return [encode_proof(p, fmt) for p, (_, fmt) in zip(proofs, batch)]
+        except Exception:
+            results = []
+            for key, fmt in batch:
+                try:
+                    results.append(encode_proof(self.trie.prove(key), fmt))
+                except Exception as e:
+                    results.append(e)
+            return results
+
+    async def prove(self, key, fmt='json'):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((key, fmt, future))
+        if self.flushing is None:
+            self.flushing = asyncio.ensure_future(self.flush())
+        return await future
+
+    async def flush(self):
+        await asyncio.sleep(self.window)
+        while len(self.pending) > 0:
+            batch = self.pending[:self.max_batch]
+            self.pending = self.pending[self.max_batch:]
+            self.batches += 1
+            try:
+                results = await self.run(self.prove_batch, [(key, fmt) for key, fmt, _ in batch])
+            except Exception as e:
+                results = [e]*len(batch)
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+        self.flushing = None
+
+    async def verify(self, d):
+        root = self.root
+        loop = asyncio.get_running_loop()
+        try:
+            h = await loop.run_in_executor(self.verifier, lambda: proof_root(decode_proof(d)))
+        except Exception:
+            return False
+        return h == root
+
+    async def handle(self, request):
+        op = request.get('op')
+        if op == 'prove':
+            return await self.prove(request['key'], request.get('format', 'json'))
+        elif op == 'verify':
+            return await self.verify(request['proof'])
+        elif op in ('insert', 'update'):
+            return await self.run(self.write, op, request['key'], request['value'])
+        elif op == 'delete':
+            return await self.run(self.write, op, request['key'])
+        elif op == 'root':
+            return self.root.hex()
+        raise Exception(f"unknown op {op}")
+
+    async def respond(self, request, writer):
+        try:
+            response = {'id': request.get('id'), 'result': await self.handle(request)}
+        except Exception as e:
+            response = {'id': request.get('id'), 'error': str(e) or type(e).__name__}
+        writer.write(json.dumps(response).encode() + b'\n')
+
+    async def connection(self, reader, writer):
+        # requests of one connection are handled concurrently, responses
+        # carry the request id and may come back out of order
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    writer.write(json.dumps({'id': None, 'error': 'malformed request'}).encode() + b'\n')
+                    continue
+                task = asyncio.ensure_future(self.respond(request, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if len(tasks) > 0:
+                await asyncio.gather(*tasks)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8765, unix=None):
+        if unix is not None:
+            return await asyncio.start_unix_server(self.connection, path=unix)
+        return await asyncio.start_server(self.connection, host, port)
+
+    def close(self):
+        self.writer.shutdown()
+        self.verifier.shutdown()
+
+
+class PMclient:
+
+    def __init__(self, reader, writer):
+        self.reader  = reader
+        self.writer  = writer
+        self.next_id = 0
+        self.waiting = {}
+        self.task    = asyncio.ensure_future(self.receive())
+
+    @staticmethod
+    async def connect(host='127.0.0.1', port=8765, unix=None):
+        if unix is not None:
+            reader, writer = await asyncio.open_unix_connection(unix)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return PMclient(reader, writer)
+
+    async def receive(self):
+        while True:
+            line = await self.reader.readline()
+            if len(line) == 0:
+                break
+            response = json.loads(line)
+            future = self.waiting.pop(response['id'], None)
+            if future is None:
+                continue
+            if 'error' in response:
+                future.set_exception(Exception(response['error']))
+            else:
+                future.set_result(response['result'])
+        for future in self.waiting.values():
+            future.set_exception(ConnectionError("connection closed"))
+        self.waiting = {}
+
+    async def request(self, op, **args):
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[self.next_id] = future
+        self.writer.write(json.dumps(dict(args, id=self.next_id, op=op)).encode() + b'\n')
+        await self.writer.drain()
+        return await future
+
+    async def close(self):
+        self.writer.close()
+        await self.task
+
+
+async def load(clients, requests, keys, fmt, host, port, unix):
+    setup = await PMclient.connect(host, port, unix)
+    # keys left over from an earlier run fail to insert and are kept as they are
+    await asyncio.gather(*[setup.request('insert', key=f'key-{i}', value=f'value-{i}') for i in range(keys)], return_exceptions=True)
+
+    latencies = []
+    async def client(seed):
+        rng = random.Random(seed)
+        c = await PMclient.connect(host, port, unix)
+        for _ in range(requests):
+            t = time.perf_counter_ns()
+            proof = await c.request('prove', key=f'key-{rng.randrange(keys)}', format=fmt)
+            latencies.append(time.perf_counter_ns() - t)
+        assert await c.request('verify', proof=proof)
+        await c.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[client(i) for i in range(clients)])
+    total = time.perf_counter() - t0
+    await setup.close()
+
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(len(latencies) * q / 100))] / 1000
+    print(f"{len(latencies)} proofs, {len(latencies)/total:.0f}/s, p50 {p(50):.0f}us, p99 {p(99):.0f}us")
+
+async def serve(service, host, port, unix):
+    server = await service.start(host, port, unix)
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name in ('serve', 'load'):
+        p = sub.add_parser(name)
+        p.add_argument('--host', default='127.0.0.1')
+        p.add_argument('--port', type=int, default=8765)
+        p.add_argument('--unix')
+    sub.choices['serve'].add_argument('--load')
+    sub.choices['serve'].add_argument('--window-ms', type=float, default=2)
+    sub.choices['load'].add_argument('--clients', type=int, default=32)
+    sub.choices['load'].add_argument('--requests', type=int, default=200)
+    sub.choices['load'].add_argument('--keys', type=int, default=10000)
+    sub.choices['load'].add_argument('--format', default='json', choices=['json', 'cbor'])
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        trie = None
+        if args.load is not None:
+            with open(args.load) as f:
+                trie = PMtrie.FromNDJSON(f)
+        asyncio.run(serve(PMservice(trie, window=args.window_ms / 1000), args.host, args.port, args.unix))
+    else:
+        asyncio.run(load(args.clients, args.requests, args.keys, args.format, args.host, args.port, args.unix))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Versioned roots with copy-on-write updates. Committed roots are never
+# mutated again, so readers can prove against any retained root without
+# locking while the writer prepares the next one. Unchanged subtrees are
+# shared between all versions.
+
+from collections import OrderedDict
+
+from helpers import *
+from pmtrie import PMtrie
+
+class PMhistory:
+
+    def __init__(self, trie=None, depth=16):
+        self.depth     = depth
+        self.snapshots = OrderedDict()
+        self.working   = trie._copy_node() if trie is not None else PMtrie()
+        self.working.deferred = True
+        self.owned     = set()
+        self.commit()
+
+    def writable(self, path):
+        # copies every node on path not created since the last commit, so the
+        # in-place mutators of PMtrie only touch nodes of the working version
+        node = self.working
+        while node.get_type() == PMtrie.TYPE_BRANCH and path.startswith(node.prefix):
+            path = path[len(node.prefix):]
+            branch = nibble(path[0])
+            child = node.children[branch]
+            if child is None:
+                return
+            if id(child) not in self.owned:
+                child = child._copy_node()
+                node.children[branch] = child
+                self.owned.add(id(child))
+            node = child
+            path = path[1:]
+
+    def own(self, path):
+        # marks the nodes on path, including ones just created, as private
+        node = self.working
+        while node.get_type() == PMtrie.TYPE_BRANCH and path.startswith(node.prefix):
+            path = path[len(node.prefix):]
+            node = node.children[nibble(path[0])]
+            if node is None:
+                return
+            self.owned.add(id(node))
+            path = path[1:]
+
+    def insert(self, key, value):
+        path = to_path(key)
+        self.writable(path)
+        self.working.insert(key, value)
+        self.own(path)
+        return self
+
+    def update(self, key, value):
+        path = to_path(key)
+        self.writable(path)
+        self.working.update(key, value)
+        self.own(path)
+        return self
+
+    def delete(self, key):
+        path = to_path(key)
+        self.writable(path)
+        # a collapsing branch is replaced by a new node, its other child stays shared
+        self.working.delete(key)
+        self.own(path)
+        return self
+
+    def commit(self):
+        root = self.working.commit()
+        self.snapshots[root] = self.working
+        self.snapshots.move_to_end(root)
+        while len(self.snapshots) > self.depth:
+            self.snapshots.popitem(last=False)
+
+        self.working = self.working._copy_node()
+        self.owned = set()
+        return root
+
+    def snapshot(self, root=None):
+        if root is None:
+            return next(reversed(self.snapshots.values()))
+        if root not in self.snapshots:
+            raise Exception(f"no snapshot for root {root.hex()}")
+        return self.snapshots[root]
+
+    def roots(self):
+        return list(self.snapshots)
+
+    def prove(self, key, root=None):
+        return self.snapshot(root).prove(key)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Content-addressed node stores: nodes are saved under their hash and
+# loaded on demand as a trie is walked.
+
+import sqlite3
+import struct
+from collections import OrderedDict
+
+from helpers import *
+from pmtrie import PMtrie
+
+NODE_LEAF   = 1
+NODE_BRANCH = 2
+NODE_HASHED_LEAF = 3
+
+ABSENT = 0xFFFFFFFF
+
+def encode_optional(b):
+    return struct.pack('>I', ABSENT) if b is None else struct.pack('>I', len(b)) + b
+
+def read_optional(data, offset):
+    n, = struct.unpack_from('>I', data, offset)
+    if n == ABSENT:
+        return None, offset + 4
+    return bytes(data[offset+4:offset+4+n]), offset + 4 + n
+
+def encode_leaf(node):
+    # leaves inserted prehashed may lack the key or raw value, they are
+    # stored with their path and value digest instead
+    if node.key is not None and node.value is not None:
+        return bytes([NODE_LEAF]) + pack_nibbles(node.prefix) + encode_optional(node.key) + encode_optional(node.value)
+    return bytes([NODE_HASHED_LEAF]) + pack_nibbles(node.prefix) + bytes.fromhex(node.leaf_path()) + node.value_digest() + encode_optional(node.key) + encode_optional(node.value)
+
+def read_leaf(data, kind, offset, node):
+    # fills in the leaf record at offset (after the prefix), returns the offset after it
+    if kind == NODE_HASHED_LEAF:
+        node.path = bytes(data[offset:offset+DIGEST_LENGTH]).hex()
+        node.vdigest = bytes(data[offset+DIGEST_LENGTH:offset+2*DIGEST_LENGTH])
+        offset += 2*DIGEST_LENGTH
+    node.key, offset = read_optional(data, offset)
+    node.value, offset = read_optional(data, offset)
+    node.size = 1
+    return offset
+
+def encode_node(node, child_hashes=True):
+    if node.get_type() == PMtrie.TYPE_LEAF:
+        return encode_leaf(node)
+    elif node.get_type() == PMtrie.TYPE_BRANCH:
+        bitmap = 0
+        hashes = []
+        for i, child in enumerate(node.children):
+            if child is not None:
+                bitmap |= 1 << i
+                if child_hashes:
+                    hashes.append(child.hash)
+        return bytes([NODE_BRANCH]) + pack_nibbles(node.prefix) + struct.pack('>QH', node.size, bitmap) + b''.join(hashes)
+    else:
+        raise Exception("can't encode an empty trie")
+
+def read_node(data, offset, hash, source=None, child_hashes=True):
+    # returns the node and the offset after it; without child_hashes the
+    # children of a branch are left as True for the caller to fill in
+    kind = data[offset]
+    prefix, offset = unpack_nibbles(data, offset + 1)
+    node = PMtrie(prefix=prefix, hash=hash)
+    if kind == NODE_LEAF or kind == NODE_HASHED_LEAF:
+        offset = read_leaf(data, kind, offset, node)
+    elif kind == NODE_BRANCH:
+        node.size, bitmap = struct.unpack_from('>QH', data, offset)
+        offset += 10
+        node.children = [None]*16
+        for i in range(16):
+            if bitmap & (1 << i):
+                if child_hashes:
+                    node.children[i] = PMtrie.Stub(bytes(data[offset:offset+DIGEST_LENGTH]), source)
+                    offset += DIGEST_LENGTH
+                else:
+                    node.children[i] = True
+    else:
+        raise Exception("unknown node type")
+    if source is not None:
+        node.source = source
+    return node, offset
+
+def decode_node(data, hash, source=None):
+    return read_node(memoryview(data), 0, hash, source)[0]
+
+def dumps_trie(trie):
+    # whole subtrie in preorder, each node as its hash and record
+    out = []
+
+    def loop(node):
+        out.append(node.hash)
+        out.append(encode_node(node, child_hashes=False))
+        if node.get_type() == PMtrie.TYPE_BRANCH:
+            for child in node.children:
+                if child is not None:
+                    loop(child)
+
+    if trie.get_type() != PMtrie.TYPE_ROOT:
+        loop(trie)
+    return b''.join(out)
+
+def loads_trie(data, verify=False):
+    # with verify, the stored hashes are ignored and every hash is computed
+    # again from the keys and values, which have to sit at their paths
+    data = memoryview(data)
+    if len(data) == 0:
+        return PMtrie()
+
+    def loop(offset, position):
+        node, offset = read_node(data, offset + DIGEST_LENGTH, bytes(data[offset:offset+DIGEST_LENGTH]), child_hashes=False)
+        if node.children is not None:
+            for i in range(16):
+                if node.children[i] is not None:
+                    node.children[i], offset = loop(offset, position + node.prefix + '%x' % i)
+        if verify:
+            recompute(node, position + node.prefix)
+        return node, offset
+
+    def recompute(node, path):
+        if node.children is not None:
+            node.size = sum(child.size for child in node.children if child is not None)
+            node.hash = PMtrie.ComputeHash(node.prefix, root=node.compute_root())
+            return
+        if len(path) != 2*DIGEST_LENGTH or (node.path is not None and node.path != path) or (node.key is not None and to_path(node.key) != path):
+            raise Exception(f"leaf at {path} is corrupt")
+        if node.value is not None:
+            node.vdigest = digest(node.value)
+        node.hash = PMtrie.ComputeHash(node.prefix, value=node.value_digest())
+
+    return loop(0, '')[0]
+
+
+class NodeCache:
+    # bounded LRU of nodes loaded from a source; trim() turns the least
+    # recently used unmodified ones back into stubs
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.resident = OrderedDict()
+
+    def track(self, node, ref=None):
+        self.resident[id(node)] = (node, node._hash, ref)
+        self.resident.move_to_end(id(node))
+
+    def touch(self, node):
+        # called on every access of a resident node, so trim() evicts the
+        # least recently used rather than the first loaded (the root)
+        try:
+            self.resident.move_to_end(id(node))
+        except KeyError:
+            pass
+
+    def trim(self):
+        while len(self.resident) > self.capacity:
+            _, (node, h, ref) = self.resident.popitem(last=False)
+            if node.source is self and not node.dirty and node._hash == h and not node.is_stub():
+                deferred = node.deferred
+                node.__dict__ = PMtrie.Stub(h, self, ref).__dict__
+                if deferred:
+                    node.deferred = True
+
+
+class NodeStore(NodeCache):
+    # subclasses provide get/put/contains/get_root/set_root/flush
+
+    def open(self):
+        root = self.get_root()
+        if root is None:
+            return PMtrie()
+        node = PMtrie.Stub(root, self)
+        self.resolve(node)
+        return node
+
+    def resolve(self, node):
+        h = node.hash
+        data = self.get(h)
+        if data is None:
+            raise Exception(f"node {h.hex()} not in store")
+        deferred = node.deferred
+        node.__dict__ = decode_node(data, h, self).__dict__
+        if deferred:
+            node.deferred = True
+        self.track(node)
+
+    def commit(self, trie):
+        root = trie.commit()
+        written = []
+
+        def loop(node):
+            if node is None or node.is_stub():
+                return
+            h = node.hash
+            if self.contains(h):
+                return
+            if node.get_type() == PMtrie.TYPE_BRANCH:
+                for child in node.children:
+                    loop(child)
+            self.put(h, encode_node(node))
+            written.append(node)
+
+        if trie.get_type() != PMtrie.TYPE_ROOT:
+            loop(trie)
+        self.set_root(root if trie.get_type() != PMtrie.TYPE_ROOT else None)
+        self.flush()
+
+        for node in written:
+            node.source = self
+            self.track(node)
+        self.trim()
+        return root
+
+
+class MemoryNodeStore(NodeStore):
+
+    def __init__(self, capacity=100000):
+        super().__init__(capacity)
+        self.nodes = {}
+        self.root = None
+
+    def get(self, h):
+        return self.nodes.get(h)
+
+    def put(self, h, data):
+        self.nodes[h] = data
+
+    def contains(self, h):
+        return h in self.nodes
+
+    def get_root(self):
+        return self.root
+
+    def set_root(self, h):
+        self.root = h
+
+    def flush(self):
+        pass
+
+
+class SqliteNodeStore(NodeStore):
+
+    def __init__(self, path, capacity=100000):
+        super().__init__(capacity)
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS nodes (hash BLOB PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID')
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value BLOB)')
+        self.db.commit()
+
+    def get(self, h):
+        row = self.db.execute('SELECT data FROM nodes WHERE hash = ?', (h,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, h, data):
+        self.db.execute('INSERT OR IGNORE INTO nodes (hash, data) VALUES (?, ?)', (h, data))
+
+    def contains(self, h):
+        return self.db.execute('SELECT 1 FROM nodes WHERE hash = ?', (h,)).fetchone() is not None
+
+    def get_root(self):
+        row = self.db.execute("SELECT value FROM meta WHERE name = 'root'").fetchone()
+        return row[0] if row is not None else None
+
+    def set_root(self, h):
+        self.db.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('root', ?)", (h,))
+
+    def flush(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
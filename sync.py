@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Chunked state sync. A chunk is the subtrie at a position, the path
+# prefix its node starts after: small subtries are sent as their leaves,
+# larger ones as a branch header with the hashes of the children, whose
+# positions the receiver then asks for. Every chunk carries the proof steps
+# from the root down to its position, so it is checked against the trusted
+# root on its own and chunks can be fetched in parallel and in any order.
+# Subtries the receiver already holds with the right hash are not fetched.
+# Leaves without key or value (insert_prehashed) are sent as their path and
+# value digest, with whatever of key and value they have.
+#
+# usage: python sync.py serve export.ndjson [--port P] [--chunk-size N]
+#        python sync.py fetch ROOT out.ndjson [--port P] [--workers W]
+
+import argparse
+import json
+import socket
+import socketserver
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from helpers import *
+from pmtrie import PMtrie, PMproof
+
+def node_at(trie, position):
+    # the node starting after position and the proof steps leading to it,
+    # or (None, steps) if no node starts there
+    node = trie
+    steps = []
+    cursor = 0
+    while cursor < len(position):
+        if node.get_type() != PMtrie.TYPE_BRANCH or not position.startswith(node.prefix, cursor):
+            return None, steps
+        cursor += len(node.prefix)
+        if cursor >= len(position):
+            return None, steps
+        branch = nibble(position[cursor])
+        steps.append(node.proof_step(branch))
+        node = node.children[branch]
+        if node is None:
+            return None, steps
+        cursor += 1
+    return node, steps
+
+
+class SyncSource:
+
+    def __init__(self, trie, chunk_size=1024):
+        self.trie = trie
+        self.chunk_size = chunk_size
+
+    def chunk(self, position):
+        self.trie.commit()
+        node, steps = node_at(self.trie, position)
+        proof = PMproof(position, None)
+        proof.steps = steps
+        chunk = {'position': position, 'steps': json.loads(proof.toJSON())}
+
+        if node is None or node.get_type() == PMtrie.TYPE_ROOT:
+            chunk['leaves'] = []
+        elif node.get_type() == PMtrie.TYPE_LEAF or node.size <= self.chunk_size:
+            chunk['leaves'] = []
+            for leaf in node.leaves():
+                if leaf.key is not None and leaf.value is not None:
+                    chunk['leaves'].append([leaf.key.hex(), leaf.value.hex()])
+                else:
+                    optional = [x.hex() if x is not None else None for x in (leaf.key, leaf.value)]
+                    chunk.setdefault('hashed', []).append([leaf.leaf_path(), leaf.value_digest().hex()] + optional)
+        else:
+            chunk['prefix'] = node.prefix
+            chunk['children'] = [child.hash.hex() if child is not None else None for child in node.children]
+        if self.trie.source is not None:
+            self.trie.source.trim()
+        return json.dumps(chunk)
+
+
+class SyncReceiver:
+    # state survives a failed run(), calling it again resumes with the
+    # positions still missing
+
+    def __init__(self, root, local=None):
+        self.root     = root
+        self.local    = local
+        self.expected = {'': root}
+        self.pending  = {''}
+        self.done     = {}
+        self.fetched  = 0
+        self.reused   = 0
+
+    def reuse(self, position):
+        # takes the subtrie at position from the local trie if it matches
+        if self.local is None:
+            return False
+        node, _ = node_at(self.local, position)
+        if node is None or node.get_type() == PMtrie.TYPE_ROOT or node.hash != self.expected[position]:
+            return False
+        self.done[position] = node
+        self.reused += 1
+        return True
+
+    def verify(self, data):
+        # checks a chunk against the root and returns (position, node, children)
+        chunk = json.loads(data)
+        if 'error' in chunk:
+            raise Exception(chunk['error'])
+        position = chunk['position']
+        steps = [PMproof.deserialize_step(step) for step in chunk['steps']]
+
+        if 'leaves' in chunk:
+            entries = []
+            for k, v in chunk['leaves']:
+                key = bytes.fromhex(k)
+                entries.append((to_path(key), key, bytes.fromhex(v)))
+            for path, d, k, v in chunk.get('hashed', []):
+                key = bytes.fromhex(k) if k is not None else None
+                value = bytes.fromhex(v) if v is not None else None
+                vdigest = bytes.fromhex(d)
+                if len(path) != 2*DIGEST_LENGTH or (key is not None and to_path(key) != path) or (value is not None and digest(value) != vdigest):
+                    raise Exception(f"malformed leaf in chunk {position}")
+                entries.append((path, key, value, vdigest))
+            entries.sort(key=lambda e: e[0])
+            if any(not entry[0].startswith(position) for entry in entries):
+                raise Exception(f"leaf outside of chunk {position}")
+            node = PMtrie.FromSorted(entries, depth=len(position))
+            children = None
+            h = node.hash
+        else:
+            prefix = chunk['prefix']
+            hashes = [bytes.fromhex(x) if x is not None else None for x in chunk['children']]
+            node = prefix
+            children = {i: h for i, h in enumerate(hashes) if h is not None}
+            h = PMtrie.ComputeHash(prefix, root=merkle_root(hashes))
+
+        if position in self.expected and h != self.expected[position]:
+            raise Exception(f"chunk {position} does not match its parent")
+        cursors = [0]
+        for step in steps:
+            cursors.append(cursors[-1] + 1 + step['skip'])
+        if cursors[-1] != len(position):
+            raise Exception(f"proof of chunk {position} does not reach it")
+        for ix in range(len(steps) - 1, -1, -1):
+            h = PMproof.step_root(steps[ix], position, cursors[ix], h)
+        if h != self.root:
+            raise Exception(f"chunk {position} does not match the root")
+        return position, node, children
+
+    def accept(self, position, node, children):
+        # node is the subtrie of a leaves chunk, or the prefix of a branch header
+        self.fetched += 1
+        self.pending.discard(position)
+        if children is None:
+            self.done[position] = node
+            return
+        self.done[position] = (node, sorted(children))
+        for i, h in children.items():
+            below = position + node + '%x' % i
+            self.expected[below] = h
+            if below not in self.done and not self.reuse(below):
+                self.pending.add(below)
+
+    def run(self, transport, workers=4):
+        if self.pending == {''} and self.reuse(''):
+            self.pending = set()
+        errors = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            running = {}
+            while True:
+                if len(errors) == 0:
+                    for position in sorted(self.pending - set(running.values())):
+                        running[executor.submit(lambda p: self.verify(transport.fetch(p)), position)] = position
+                if len(running) == 0:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    del running[future]
+                    try:
+                        self.accept(*future.result())
+                    except Exception as e:
+                        errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+        return self.trie()
+
+    def trie(self):
+        if len(self.pending) > 0:
+            raise Exception("sync incomplete")
+
+        # subtries taken from the local trie are shared with it, not copied
+        def assemble(position):
+            done = self.done[position]
+            if type(done) is not tuple:
+                return done
+            prefix, children = done
+            branch = PMtrie.Branch(prefix, {i: assemble(position + prefix + '%x' % i) for i in children})
+            branch.size = sum(child.size for child in branch.children if child is not None)
+            return branch
+
+        return assemble('')
+
+
+class LocalTransport:
+
+    def __init__(self, source):
+        self.source = source
+
+    def fetch(self, position):
+        return self.source.chunk(position)
+
+
+class SyncHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                response = self.server.source.chunk(json.loads(line)['position'])
+            except Exception as e:
+                response = json.dumps({'error': str(e) or type(e).__name__})
+            self.wfile.write(response.encode() + b'\n')
+
+
+class SyncServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, source, host='127.0.0.1', port=8766):
+        self.source = source
+        super().__init__((host, port), SyncHandler)
+
+
+class SocketTransport:
+    # one connection per fetching thread
+
+    def __init__(self, host='127.0.0.1', port=8766):
+        self.address = (host, port)
+        self.local = threading.local()
+        self.connections = []
+
+    def fetch(self, position):
+        if not hasattr(self.local, 'file'):
+            conn = socket.create_connection(self.address)
+            self.local.file = conn.makefile('rwb')
+            self.connections.append((conn, self.local.file))
+        f = self.local.file
+        f.write(json.dumps({'position': position}).encode() + b'\n')
+        f.flush()
+        line = f.readline()
+        if len(line) == 0:
+            raise ConnectionError("connection closed")
+        return line
+
+    def close(self):
+        for conn, f in self.connections:
+            f.close()
+            conn.close()
+        self.connections = []
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    serve = sub.add_parser('serve')
+    serve.add_argument('ndjson')
+    serve.add_argument('--chunk-size', type=int, default=1024)
+    fetch = sub.add_parser('fetch')
+    fetch.add_argument('root')
+    fetch.add_argument('ndjson')
+    fetch.add_argument('--workers', type=int, default=4)
+    for p in (serve, fetch):
+        p.add_argument('--host', default='127.0.0.1')
+        p.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        with open(args.ndjson) as f:
+            trie = PMtrie.FromNDJSON(f)
+        print(f"serving {trie.hash.hex()}")
+        SyncServer(SyncSource(trie, args.chunk_size), args.host, args.port).serve_forever()
+    else:
+        transport = SocketTransport(args.host, args.port)
+        receiver = SyncReceiver(bytes.fromhex(args.root))
+        trie = receiver.run(transport, args.workers)
+        transport.close()
+        with open(args.ndjson, 'w') as f:
+            trie.export_ndjson(f)
+        print(f"{receiver.fetched} chunks, {trie.size} keys")
@@ -1,9 +1,30 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import unittest
+import asyncio
 import json
+import io
+import os
+import random
+import sys
+import tempfile
+import types
 
+import helpers
 from pmtrie import *
+from store import *
+from arena import *
+from verifier import *
+from parallel import *
+from snapshots import *
+from cache import *
+from service import *
+from journal import *
+from forest import *
+from sync import *
+import threading
+import instrument
+import bench
 
 key = 'key'
 value = 'value'
@@ -46,6 +67,23 @@ FOOBAR_LIST = [
   { key: 'bar', value: '42' },
 ]
 
+def reference_cbor_steps(proof):
+    # the original hex string encoder, to check the bytes encoder against
+    cbor = []
+    for step in proof.steps:
+        if step['type'] == PMproof.TYPE_BRANCH:
+            neighbors = ''.join([x.hex() for x in step['neighbors'] if x is not None])
+            cbor.append('d8799f' + bytes([step['skip']]).hex() + '5f' + '5840' + neighbors[:128] + '5840' + neighbors[128:] + 'ffff')
+        elif step['type'] == PMproof.TYPE_FORK:
+            if len(step['neighbor']['prefix']) < 16:
+                _prefix = bytes([0x40 + len(step['neighbor']['prefix'])]).hex() + step['neighbor']['prefix'].hex()
+            else:
+                _prefix = '58' + bytes([len(step['neighbor']['prefix'])]).hex() + step['neighbor']['prefix'].hex()
+            cbor.append('d87a9f' + bytes([step['skip']]).hex() + 'd8799f' + bytes([step['neighbor']['nibble']]).hex() + _prefix  + '5820' + step['neighbor']['root'].hex() + 'ffff')
+        elif step['type'] == PMproof.TYPE_LEAF:
+            cbor.append('d87b9f' + bytes([step['skip']]).hex() + '5820' + step['neighbor']['key'] + '5820' + step['neighbor']['value'].hex() + 'ff')
+    return cbor
+
 class TestTrie(unittest.TestCase):
 
     def test_fruits(self):
@@ -60,6 +98,154 @@ class TestTrie(unittest.TestCase):
         print(f"target:   {target_value}")
         self.assertEqual(computed_value, target_value)
 
+    def test_bulk_fruits(self):
+        t = PMtrie.FromBulk(FRUITS_LIST)
+        self.assertEqual(t.hash.hex(), '4acd78f345a686361df77541b2e0b533f53362e36620a1fdd3a13e0b61a3b078')
+        self.assertEqual(t.size, len(FRUITS_LIST))
+        for d in FRUITS_LIST:
+            self.assertEqual(t.prove(d['key']).verify().hex(), t.hash.hex())
+
+    def test_bulk_matches_insert(self):
+        for n in [0, 1, 2, 3, 17, 500]:
+            l = [{key: f'key-{i}', value: f'value-{i}'} for i in range(n)]
+            t1 = PMtrie.FromList(l)
+            t2 = PMtrie.FromBulk(l)
+            self.assertEqual(t1.hash.hex(), t2.hash.hex())
+            self.assertEqual(t1.size, n)
+            self.assertEqual(t2.size, n)
+
+        with self.assertRaises(Exception) as context:
+            PMtrie.FromBulk([{key: 'aaa', value: '1'}, {key: 'aaa', value: '2'}])
+
+    def test_deferred(self):
+        t = PMtrie(deferred=True)
+        for d in FRUITS_LIST:
+            t.insert(d['key'], d['value'])
+        self.assertTrue(t.dirty)
+        self.assertEqual(t.commit().hex(), '4acd78f345a686361df77541b2e0b533f53362e36620a1fdd3a13e0b61a3b078')
+        self.assertFalse(t.dirty)
+
+        t.insert('kiwano[uid: 0]', '🤷')
+        self.assertTrue(t.dirty)
+        proof = t.prove(FRUITS_LIST[0]['key'])
+        self.assertEqual(proof.verify().hex(), PMtrie.FromList(FRUITS_LIST + [{key: 'kiwano[uid: 0]', value: '🤷'}]).hash.hex())
+
+    def test_delete(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        for i in range(len(FRUITS_LIST)):
+            t_without = PMtrie.FromList(FRUITS_LIST[:i] + FRUITS_LIST[i+1:])
+            t.delete(FRUITS_LIST[i]['key'])
+            self.assertEqual(t.hash.hex(), t_without.hash.hex())
+            self.assertEqual(t.size, len(FRUITS_LIST) - 1)
+            t.insert(FRUITS_LIST[i]['key'], FRUITS_LIST[i]['value'])
+            self.assertEqual(t.hash.hex(), '4acd78f345a686361df77541b2e0b533f53362e36620a1fdd3a13e0b61a3b078')
+
+        for i in range(len(FRUITS_LIST)):
+            t.delete(FRUITS_LIST[i]['key'])
+            self.assertEqual(t.hash.hex(), PMtrie.FromList(FRUITS_LIST[i+1:]).hash.hex())
+        self.assertEqual(t.hash, NULL_HASH)
+
+        with self.assertRaises(Exception) as context:
+            t.delete('apple[uid: 58]')
+
+    def test_update(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        t.update('banana[uid: 218]', '🍌🍌')
+        l = [dict(d, value='🍌🍌') if d['key'] == 'banana[uid: 218]' else d for d in FRUITS_LIST]
+        self.assertEqual(t.hash.hex(), PMtrie.FromList(l).hash.hex())
+        self.assertEqual(t.prove('banana[uid: 218]').verify().hex(), t.hash.hex())
+
+        with self.assertRaises(Exception) as context:
+            t.update('durian[uid: 0]', '🤷')
+
+    def test_prove_many(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        keys = [d['key'] for d in reversed(FRUITS_LIST)] + ['kiwi[uid: 0]']
+        proofs = t.prove_many(keys)
+        self.assertEqual(len(proofs), len(keys))
+        for k, proof in zip(keys, proofs):
+            self.assertEqual(proof.toCBOR(), t.prove(k).toCBOR())
+            self.assertEqual(proof.verify().hex(), t.hash.hex())
+        self.assertEqual(t.prove_many([]), [])
+
+    def test_multiproof(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        proofs = t.prove_many([d['key'] for d in FRUITS_LIST])
+        m = PMmultiproof.FromProofs(proofs)
+        self.assertLess(len(m.steps), sum(len(p.steps) for p in proofs))
+        self.assertEqual(m.verify().hex(), t.hash.hex())
+
+        m2 = PMmultiproof.fromJSON(m.toJSON())
+        self.assertEqual(m2.verify().hex(), t.hash.hex())
+        for proof, original in zip(m2.toProofs(), proofs):
+            self.assertEqual(proof.toCBOR(), original.toCBOR())
+
+        m2.proofs[0] = (m2.proofs[0][0], b'rotten', m2.proofs[0][2])
+        self.assertIsNone(m2.verify())
+
+    def test_diff(self):
+        def expected(a, b):
+            da = {encode_string(d['key']): encode_string(d['value']) for d in a}
+            db = {encode_string(d['key']): encode_string(d['value']) for d in b}
+            result = set()
+            for k in da:
+                if k not in db:
+                    result.add(('removed', k, da[k]))
+                elif da[k] != db[k]:
+                    result.add(('changed', k, da[k], db[k]))
+            for k in db:
+                if k not in da:
+                    result.add(('added', k, db[k]))
+            return result
+
+        l = [{key: f'key-{i}', value: f'value-{i}'} for i in range(400)]
+        changed = [dict(d, value='new') if i % 37 == 0 else d for i, d in enumerate(l)]
+        cases = [
+            (FRUITS_LIST, FRUITS_LIST),
+            (FRUITS_LIST, FRUITS_LIST[3:] + [{key: 'kiwano[uid: 0]', value: '🤷'}]),
+            (l, changed[5:] + FRUITS_LIST),
+            (l[:3], l[:200]),
+            (l[:1], l[1:2]),
+            ([], l[:10]),
+            (l[:10], []),
+        ]
+        for a, b in cases:
+            ta, tb = PMtrie.FromList(a), PMtrie.FromList(b)
+            result = list(ta.diff(tb))
+            self.assertEqual(len(result), len(set(result)))
+            self.assertEqual(set(result), expected(a, b))
+            self.assertEqual(set(tb.diff(ta)), expected(b, a))
+
+    def test_items(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        items = list(t.items())
+        self.assertEqual(len(items), len(FRUITS_LIST))
+        self.assertEqual([to_path(k) for k, _ in items], sorted(to_path(d['key']) for d in FRUITS_LIST))
+        self.assertEqual(set(t.keys()), {encode_string(d['key']) for d in FRUITS_LIST})
+
+        for prefix in ['', '5', '5e', '5ed7', '5ed71f91166242e8477758810ad103aff35313b175b1762b0efe800fa9a126d2', 'f', 'fff']:
+            expected = sorted(to_path(d['key']) for d in FRUITS_LIST if to_path(d['key']).startswith(prefix))
+            self.assertEqual([to_path(k) for k in t.keys(prefix)], expected)
+        self.assertEqual(list(PMtrie().items()), [])
+
+    def test_export_import(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+
+        f = io.StringIO()
+        t.export_ndjson(f)
+        f.seek(0)
+        self.assertEqual(PMtrie.FromNDJSON(f).hash.hex(), t.hash.hex())
+
+        f = io.BytesIO()
+        t.export_binary(f)
+        f.seek(0)
+        self.assertEqual(PMtrie.FromBinary(f).hash.hex(), t.hash.hex())
+
+        lines = [json.dumps({'key': encode_string(d['key']).hex(), 'value': encode_string(d['value']).hex()}) for d in FRUITS_LIST]
+        self.assertEqual(PMtrie.FromNDJSON(io.StringIO('\n'.join(lines)), presorted=False).hash.hex(), t.hash.hex())
+        with self.assertRaises(Exception) as context:
+            PMtrie.FromNDJSON(io.StringIO('\n'.join(lines)))
+
     def test_duplicate(self):
         with self.assertRaises(Exception) as context:
             t = PMtrie()
@@ -120,6 +306,27 @@ class TestTrie(unittest.TestCase):
         serialized_steps = proof.toJSON()
         self.assertEqual(serialized_steps, '[{"type": "branch", "skip": 0, "neighbors": "c7bfa4472f3a98ebe0421e8f3f03adf0f7c4340dec65b4b92b1c9f0bed209eb47238ba5d16031b6bace4aee22156f5028b0ca56dc24f7247d6435292e82c039c3490a825d2e8deddf8679ce2f95f7e3a59d9c3e1af4a49b410266d21c9344d6d79519b8cdfbd053e5a86cf28a781debae71638cd77f85aad4b88869373d9dcfd"}, {"type": "leaf", "skip": 0, "neighbor": {"key": "5cddcd30a0a388cf6feb3fd6e112c96e9daf23e3a9c8a334e7044650471aaa9e", "value": "f429821ddf89c9df3c7fbb5aa6fadb6c246d75ceede53173ce59d70dde375d14"}}, {"type": "leaf", "skip": 0, "neighbor": {"key": "5e7ccfedd44c90423b191ecca1eb21dfbac865d561bace8c0f3e94ae7edf4440", "value": "7c3715aba2db74d565a6ce6cc72f20d9cb4652ddb29efe6268be15b105e40911"}}]')
 
+    def test_proof_cbor_roundtrip(self):
+        l = [{key: f'key-{i}', value: f'value-{i}'} for i in range(300)]
+        t = PMtrie.FromList(l)
+        types = set()
+        for d in l:
+            proof = t.prove(d['key'])
+            cbor = proof.toCBORbytes()
+            reference = reference_cbor_steps(proof)
+            self.assertEqual(cbor.hex(), '9f' + ''.join(reference) + 'ff')
+            self.assertEqual(proof.toCBOR(), cbor.hex())
+            self.assertEqual(proof.toCBORlist(), reference)
+            types.update(step['type'] for step in proof.steps)
+
+            decoded = PMproof.fromCBOR(cbor, proof.path, proof.value)
+            self.assertEqual(decoded.toJSON(full=True), proof.toJSON(full=True))
+            self.assertEqual(decoded.verify().hex(), t.hash.hex())
+        self.assertEqual(types, {PMproof.TYPE_BRANCH, PMproof.TYPE_FORK, PMproof.TYPE_LEAF})
+
+        with self.assertRaises(Exception) as context:
+            PMproof.fromCBOR(bytes.fromhex('9fd8799f00ff'))
+
     def test_blockchain(self):
 
         genesis = {
@@ -181,6 +388,7 @@ class TestTrie(unittest.TestCase):
             t.insert_digest(h)
             proof = t.prove_digest(h).toCBOR()
             self.assertEqual(proof, expected_proof) 
+            self.assertEqual(PMproof.fromCBOR(bytes.fromhex(expected_proof)).toCBOR(), expected_proof)
 
     def test_more_proofs(self):
         t = PMtrie()
@@ -195,6 +403,655 @@ class TestTrie(unittest.TestCase):
                 proof = '9f' + ''.join(proof_as_list) + 'ff'
                 self.assertEqual(proof, p[2])
 
+    def test_merkle_levels(self):
+        children = [digest(bytes([i])) if i % 3 else None for i in range(16)]
+        levels = merkle_levels(children)
+        self.assertEqual(levels[4][0], merkle_root(children))
+
+        for me in range(16):
+            neighbors = merkle_proof(children, me)
+            half = 8 if me < 8 else 0
+            self.assertEqual(neighbors[0], merkle_root(children[half:half+8], size=8))
+            self.assertEqual(neighbors[3], children[me ^ 1] or NULL_HASH)
+
+        for i in [0, 5, 15, 5]:
+            children[i] = digest(bytes([i, 42]))
+            self.assertEqual(merkle_update(levels, i, children[i]), merkle_root(children))
+        children = [None]*16
+        self.assertEqual(merkle_levels(children)[4][0], EMPTY_HASHES[4])
+
+
+    def test_insert_prehashed(self):
+        t = PMtrie()
+        for d in FRUITS_LIST:
+            key = encode_string(d['key'])
+            value = encode_string(d['value'])
+            t.insert_prehashed(digest(key), value, key=key, value_digest=digest(value))
+        self.assertEqual(t.hash.hex(), '4acd78f345a686361df77541b2e0b533f53362e36620a1fdd3a13e0b61a3b078')
+        self.assertEqual(t.prove(FRUITS_LIST[3]['key']).verify(), t.hash)
+
+        # keys and values are optional once their digests are known
+        t2 = PMtrie()
+        for d in FRUITS_LIST:
+            t2.insert_prehashed(to_path(d['key']), None, value_digest=digest(encode_string(d['value'])))
+        self.assertEqual(t2.hash, t.hash)
+        self.assertEqual(t2.prove(FRUITS_LIST[3]['key']).steps, t.prove(FRUITS_LIST[3]['key']).steps)
+        self.assertEqual(len(list(t2.diff(t))), 0)
+
+        with self.assertRaises(Exception):
+            t.insert(FRUITS_LIST[0]['key'], 'again')
+        with self.assertRaises(Exception):
+            t2.insert_prehashed(to_path('kiwi'), None)
+
+    def test_prehashed_streaming(self):
+        t = PMtrie()
+        for d in FRUITS_LIST:
+            t.insert_prehashed(to_path(d['key']), None, value_digest=digest(encode_string(d['value'])))
+        key = FRUITS_LIST[0]['key']
+
+        # leaves holding only digests cannot be streamed as key/value pairs
+        self.assertTrue(t.contains(key))
+        self.assertEqual(t.get('kiwi', b'none'), b'none')
+        for f in (lambda: t.get(key), lambda: t.get_many([key]), lambda: list(t.items()), lambda: list(t.keys()),
+                  lambda: t.export_ndjson(io.StringIO()), lambda: t.export_binary(io.BytesIO())):
+            with self.assertRaisesRegex(Exception, 'no (key|value) stored'):
+                f()
+
+    def test_transition_proofs(self):
+        t = PMtrie.FromList(FRUITS_LIST[:20])
+        proof, old_root, new_root = t.insert_with_proof(FRUITS_LIST[20]['key'], FRUITS_LIST[20]['value'])
+        self.assertEqual(old_root, PMtrie.FromList(FRUITS_LIST[:20]).hash)
+        self.assertEqual(new_root, PMtrie.FromList(FRUITS_LIST[:21]).hash)
+        self.assertEqual(proof.toCBOR(), t.prove(FRUITS_LIST[20]['key']).toCBOR())
+        self.assertEqual(proof.verify(), new_root)
+        self.assertEqual(proof.verify(False), old_root)
+
+        changes = [('insert', d['key'], d['value']) for d in FRUITS_LIST[21:]]
+        changes += [('update', FRUITS_LIST[0]['key'], 'new'), ('delete', FRUITS_LIST[1]['key'])]
+        transitions = t.apply_with_proofs(changes)
+        self.assertEqual(transitions[0][1], new_root)
+        for (_, _, root), (_, old, _) in zip(transitions, transitions[1:]):
+            self.assertEqual(root, old)
+        self.assertEqual(transitions[-1][2], t.hash)
+
+        proof, old_root, new_root = transitions[-2]
+        self.assertEqual(proof.verify(), new_root)
+        proof.value = encode_string(FRUITS_LIST[0]['value'])
+        self.assertEqual(proof.verify(), old_root)
+
+        proof, old_root, new_root = transitions[-1]
+        self.assertEqual(proof.verify(), old_root)
+        self.assertEqual(proof.verify(False), new_root)
+
+    def test_from_proofs(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        covered = [d['key'] for d in FRUITS_LIST[::7]]
+        s = PMtrie.FromProofs([t.prove(k) for k in covered])
+        self.assertEqual(s.hash, t.hash)
+        for k in covered:
+            self.assertEqual(s.prove(k).toCBOR(), t.prove(k).toCBOR())
+            s.update(k, 'new')
+            t.update(k, 'new')
+            self.assertEqual(s.hash, t.hash)
+
+        with self.assertRaises(Exception):
+            s.update(FRUITS_LIST[1]['key'], 'new')
+
+        # a proof without its value gives the trie without the key
+        others = [t.prove(k) for k in covered]
+        old_root = t.hash
+        proof, _, new_root = t.insert_with_proof('kiwano[uid: 0]', '🤷')
+        proof.value = None
+        s = PMtrie.FromProofs([proof] + others)
+        self.assertEqual(s.hash, old_root)
+        s.insert('kiwano[uid: 0]', '🤷')
+        self.assertEqual(s.hash, new_root)
+
+        # deletes collapse branches only when the survivor is covered
+        for k in covered[:3]:
+            s.delete(k)
+            t.delete(k)
+            self.assertEqual(s.hash, t.hash)
+
+        keys = ['k594', 'k872', 'k11']
+        t = PMtrie.FromList([{'key': k, 'value': k} for k in keys])
+        s = PMtrie.FromProofs([t.prove('k11'), t.prove('k872')])
+        s.delete('k11')
+        t.delete('k11')
+        self.assertEqual(s.hash, t.hash)
+        with self.assertRaisesRegex(Exception, 'not covered'):
+            s.delete('k872')
+        self.assertEqual(s.hash, t.hash)
+
+        self.assertEqual(PMtrie.FromProofs([]).hash, NULL_HASH)
+
+    def test_get(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        for d in FRUITS_LIST:
+            self.assertEqual(t.get(d['key']), encode_string(d['value']))
+            self.assertTrue(t.contains(d['key']))
+        self.assertIsNone(t.get('kiwano[uid: 0]'))
+        self.assertEqual(t.get('kiwano[uid: 0]', b''), b'')
+        self.assertFalse(t.contains('kiwano[uid: 0]'))
+        self.assertFalse(PMtrie().contains('kiwano[uid: 0]'))
+        self.assertEqual(t.get_many([FRUITS_LIST[0]['key'], 'kiwano[uid: 0]'], False), [encode_string(FRUITS_LIST[0]['value']), False])
+
+        with instrument.profile() as stats:
+            t.get(FRUITS_LIST[0]['key'])
+        self.assertEqual(stats['to_path']['calls'], 1)
+        self.assertNotIn('digest', stats)
+
+    def test_common_prefix(self):
+        self.assertEqual(common_prefix('abcd', 'abce'), 'abc')
+        self.assertEqual(common_prefix('abcd', 'ab'), 'ab')
+        self.assertEqual(common_prefix('', 'ab'), '')
+        self.assertEqual(common_prefix('xbcd', 'abcd'), '')
+        self.assertEqual(common_prefix('abcd', 'abcd'), 'abcd')
+
+
+class TestStore(unittest.TestCase):
+
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'trie.db')
+
+            store = SqliteNodeStore(path, capacity=4)
+            t = PMtrie.FromList(FRUITS_LIST[:20])
+            store.commit(t)
+            store.close()
+
+            store = SqliteNodeStore(path, capacity=4)
+            t = store.open()
+            self.assertEqual(t.hash.hex(), PMtrie.FromList(FRUITS_LIST[:20]).hash.hex())
+            self.assertEqual(len(store.resident), 1)
+
+            for d in FRUITS_LIST[20:]:
+                t.insert(d['key'], d['value'])
+            self.assertEqual(t.hash.hex(), '4acd78f345a686361df77541b2e0b533f53362e36620a1fdd3a13e0b61a3b078')
+            store.commit(t)
+            self.assertLessEqual(len(store.resident), 4)
+            store.close()
+
+            store = SqliteNodeStore(path, capacity=4)
+            t = store.open()
+            for d in FRUITS_LIST:
+                self.assertEqual(t.prove(d['key']).verify().hex(), t.hash.hex())
+                self.assertLessEqual(len(store.resident), 4)
+            store.close()
+
+    def test_prehashed_leaves(self):
+        t = PMtrie()
+        for d in FRUITS_LIST:
+            t.insert_prehashed(bytes.fromhex(to_path(d['key'])), None, value_digest=digest(encode_string(d['value'])))
+
+        store = MemoryNodeStore(capacity=4)
+        store.commit(t)
+        t2 = store.open()
+        self.assertEqual(t2.hash.hex(), '4acd78f345a686361df77541b2e0b533f53362e36620a1fdd3a13e0b61a3b078')
+        self.assertEqual([leaf.vdigest for leaf in t2.leaves()], [leaf.vdigest for leaf in t.leaves()])
+
+        t3 = loads_trie(dumps_trie(t))
+        t3.update(FRUITS_LIST[0]['key'], 'new')
+        t.update(FRUITS_LIST[0]['key'], 'new')
+        self.assertEqual(t3.hash, t.hash)
+        self.assertEqual(t3.prove(FRUITS_LIST[0]['key']).verify(), t.hash)
+
+    def test_store_lru(self):
+        # the root and upper branches are used by every lookup and stay resident
+        store = MemoryNodeStore(capacity=8)
+        store.commit(PMtrie.FromList(FRUITS_LIST))
+        t = store.open()
+        loads = []
+        get = store.get
+        store.get = lambda h: loads.append(h) or get(h)
+        for _ in range(3):
+            for d in FRUITS_LIST:
+                self.assertEqual(t.get(d['key']), encode_string(d['value']))
+                self.assertFalse(t.is_stub())
+        self.assertNotIn(t.hash, loads)
+        self.assertLessEqual(len(store.resident), 8)
+
+    def test_memory_store_empty(self):
+        store = MemoryNodeStore()
+        self.assertEqual(store.open().get_type(), PMtrie.TYPE_ROOT)
+        store.commit(PMtrie.FromList(FOOBAR_LIST))
+        self.assertEqual(store.open().hash.hex(), "69509862d51b65b26be6e56d3286d2ff00a0e8091d004721f4d2ce6918325c18")
+
+    def test_image(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'trie.img')
+            t = PMtrie.FromList(FRUITS_LIST)
+            t.save(path)
+
+            t2 = PMtrie.open(path, capacity=8)
+            self.assertEqual(t2.hash.hex(), t.hash.hex())
+            for item in FRUITS_LIST:
+                proof = t2.prove(item['key'])
+                self.assertEqual(proof.toCBOR(), t.prove(item['key']).toCBOR())
+                self.assertEqual(proof.verify().hex(), t.hash.hex())
+                self.assertLessEqual(len(t2.source.resident), 8)
+
+            t2.insert('kiwano[uid: 0]', '🤷')
+            t.insert('kiwano[uid: 0]', '🤷')
+            self.assertEqual(t2.hash.hex(), t.hash.hex())
+            t2.source.close()
+
+            PMtrie().save(path)
+            self.assertEqual(PMtrie.open(path).hash, NULL_HASH)
+
+
+class TestJournal(unittest.TestCase):
+
+    def test_recovery(self):
+        with tempfile.TemporaryDirectory() as d:
+            j = PMjournal(d, batch=8)
+            for item in FRUITS_LIST[:20]:
+                j.insert(item['key'], item['value'])
+            j.update(FRUITS_LIST[0]['key'], 'new')
+            j.delete(FRUITS_LIST[1]['key'])
+            root = j.commit()
+            j.insert(FRUITS_LIST[20]['key'], FRUITS_LIST[20]['value'])
+            j.file.close()
+
+            # a torn record after the last commit is dropped
+            with open(os.path.join(d, 'journal'), 'ab') as f:
+                f.write(encode_record(OP_INSERT, 99, b'x', b'y')[:-3])
+
+            j = PMjournal(d, batch=8)
+            self.assertEqual(j.trie.hash, root)
+            self.assertEqual(j.seq, 22)
+            for item in FRUITS_LIST[20:]:
+                j.insert(item['key'], item['value'])
+            j.close()
+
+            expected = PMtrie.FromList(FRUITS_LIST).update(FRUITS_LIST[0]['key'], 'new').delete(FRUITS_LIST[1]['key'])
+            j = PMjournal(d)
+            self.assertEqual(j.trie.hash, expected.hash)
+            j.close()
+
+    def test_checkpoint(self):
+        with tempfile.TemporaryDirectory() as d:
+            j = PMjournal(d, batch=4, checkpoint_every=10)
+            for item in FRUITS_LIST:
+                j.insert(item['key'], item['value'])
+            j.close()
+            self.assertTrue(os.path.exists(os.path.join(d, 'checkpoint')))
+            self.assertLess(os.path.getsize(os.path.join(d, 'journal')), 4000)
+
+            j = PMjournal(d)
+            self.assertEqual(j.trie.hash.hex(), '4acd78f345a686361df77541b2e0b533f53362e36620a1fdd3a13e0b61a3b078')
+            self.assertEqual(j.checkpoint_seq, 24)
+            self.assertEqual(j.seq, len(FRUITS_LIST))
+            j.delete(FRUITS_LIST[0]['key'])
+            j.checkpoint()
+            j.close()
+            self.assertEqual(os.path.getsize(os.path.join(d, 'journal')), 0)
+
+            j = PMjournal(d)
+            self.assertEqual(j.trie.hash, PMtrie.FromList(FRUITS_LIST[1:]).hash)
+            j.close()
+
+    def test_corrupt_checkpoint(self):
+        with tempfile.TemporaryDirectory() as d:
+            j = PMjournal(d)
+            for item in FRUITS_LIST:
+                j.insert(item['key'], item['value'])
+            j.checkpoint()
+            j.close()
+
+            # stored hashes are intact, the value is not
+            path = os.path.join(d, 'checkpoint')
+            with open(path, 'rb') as f:
+                data = bytearray(f.read())
+            pos = data.find(encode_string(FRUITS_LIST[5]['value']))
+            self.assertGreater(pos, 0)
+            data[pos] ^= 1
+            with open(path, 'wb') as f:
+                f.write(data)
+            with self.assertRaisesRegex(Exception, 'does not match its root'):
+                PMjournal(d)
+
+
+class TestVerifier(unittest.TestCase):
+
+    def test_proof_root_matches_verify(self):
+        l = [{key: f'key-{i}', value: f'value-{i}'} for i in range(200)]
+        for items in [FRUITS_LIST, FOOBAR_LIST, FRUITS_LIST[:1], l]:
+            t = PMtrie.FromList(items)
+            for d in items:
+                proof = t.prove(d['key'])
+                self.assertEqual(proof_root(proof), proof.verify())
+                self.assertEqual(proof_root(proof, including_item=False), proof.verify(False))
+
+    def test_verify_batch(self):
+        l = [{key: f'key-{i}', value: f'value-{i}'} for i in range(300)]
+        t = PMtrie.FromList(l)
+        proofs = t.prove_many([d['key'] for d in l])
+        proofs[7] = PMproof.fromJSON(proofs[7].toJSON(full=True))
+        proofs[7].value = b'rotten'
+
+        expected = [i != 7 for i in range(len(l))]
+        self.assertEqual(verify_batch(proofs, t.hash), expected)
+        self.assertEqual(verify_batch(proofs, t.hash, workers=2, chunksize=64), expected)
+        self.assertEqual(verify_batch(proofs, NULL_HASH), [False]*len(l))
+
+
+class TestParallel(unittest.TestCase):
+
+    def test_build_parallel(self):
+        l = [{key: f'key-{i}', value: f'value-{i}'} for i in range(500)]
+        for items in [FRUITS_LIST, l, FRUITS_LIST[:1], []]:
+            for depth in [1, 2]:
+                t = build_parallel(items, workers=2, depth=depth)
+                self.assertEqual(t.hash.hex(), PMtrie.FromList(items).hash.hex())
+                self.assertEqual(t.size, len(items))
+        t = build_parallel(FRUITS_LIST, workers=2)
+        self.assertEqual(t.prove(FRUITS_LIST[3]['key']).verify().hex(), t.hash.hex())
+
+    def test_dumps_trie(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        t2 = loads_trie(dumps_trie(t))
+        self.assertEqual(t2.hash.hex(), t.hash.hex())
+        t2.insert('kiwano[uid: 0]', '🤷')
+        t.insert('kiwano[uid: 0]', '🤷')
+        self.assertEqual(t2.hash.hex(), t.hash.hex())
+
+
+class TestForest(unittest.TestCase):
+
+    def test_forest(self):
+        forest = PMforest(shards=3)
+        try:
+            self.assertEqual(forest.hash, NULL_HASH)
+            for items in [FRUITS_LIST[:1], FRUITS_LIST[1:2], FRUITS_LIST[2:]]:
+                forest.insert_many(items)
+                t = PMtrie.FromList(FRUITS_LIST[:forest.size])
+                self.assertEqual(forest.hash, t.hash)
+                keys = [d['key'] for d in FRUITS_LIST[:forest.size]]
+                for key, proof in zip(keys, forest.prove_many(keys)):
+                    self.assertEqual(proof.toCBOR(), t.prove(key).toCBOR())
+
+            with self.assertRaises(Exception):
+                forest.insert_many(FRUITS_LIST[:2])
+            self.assertEqual(forest.hash.hex(), '4acd78f345a686361df77541b2e0b533f53362e36620a1fdd3a13e0b61a3b078')
+
+            forest.update(FRUITS_LIST[0]['key'], 'new')
+            forest.delete(FRUITS_LIST[1]['key'])
+            t = PMtrie.FromList(FRUITS_LIST).update(FRUITS_LIST[0]['key'], 'new').delete(FRUITS_LIST[1]['key'])
+            self.assertEqual(forest.hash, t.hash)
+            self.assertEqual(forest.prove(FRUITS_LIST[0]['key']).verify(), t.hash)
+        finally:
+            forest.close()
+
+
+class TestSync(unittest.TestCase):
+
+    def test_sync(self):
+        items = [{'key': f'key-{i}', 'value': f'value-{i}'} for i in range(500)]
+        t = PMtrie.FromBulk(items)
+        source = SyncSource(t, chunk_size=16)
+
+        class Flaky:
+            def __init__(self, fail):
+                self.fail = fail
+            def fetch(self, position):
+                if position in self.fail:
+                    self.fail.discard(position)
+                    raise ConnectionError("interrupted")
+                return source.chunk(position)
+
+        receiver = SyncReceiver(t.hash)
+        with self.assertRaises(ConnectionError):
+            receiver.run(Flaky({'', '3'}))
+        with self.assertRaises(ConnectionError):
+            receiver.run(Flaky({'3'}))
+        s = receiver.run(Flaky(set()))
+        self.assertEqual(s.hash, t.hash)
+        self.assertEqual(s.size, 500)
+        self.assertEqual(s.get('key-7'), b'value-7')
+
+        # only what changed is fetched again
+        t.update('key-7', 'new')
+        receiver = SyncReceiver(t.hash, local=s)
+        self.assertEqual(receiver.run(LocalTransport(source)).hash, t.hash)
+        self.assertLess(receiver.fetched, 5)
+        self.assertGreater(receiver.reused, 10)
+
+        class Tampered:
+            def fetch(self, position):
+                return source.chunk(position).replace(b'new'.hex(), b'old'.hex())
+        with self.assertRaises(Exception):
+            SyncReceiver(t.hash).run(Tampered())
+
+    def test_prehashed(self):
+        # key-less leaves are synced by path and value digest
+        t = PMtrie()
+        for i, d in enumerate(FRUITS_LIST):
+            key = encode_string(d['key']) if i % 3 == 0 else None
+            t.insert_prehashed(to_path(d['key']), None, key=key, value_digest=digest(encode_string(d['value'])))
+        t.update(FRUITS_LIST[1]['key'], 'plum')
+        s = SyncReceiver(t.hash).run(LocalTransport(SyncSource(t, chunk_size=4)))
+        self.assertEqual(s.hash, t.hash)
+        self.assertEqual(s.get(FRUITS_LIST[1]['key']), b'plum')
+        self.assertTrue(s.contains(FRUITS_LIST[2]['key']))
+        self.assertEqual(list(s.keys(to_path(FRUITS_LIST[0]['key']))), [encode_string(FRUITS_LIST[0]['key'])])
+
+    def test_socket(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        server = SyncServer(SyncSource(t, chunk_size=4), port=0)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        transport = SocketTransport(port=server.server_address[1])
+        try:
+            self.assertEqual(SyncReceiver(t.hash).run(transport, workers=3).hash, t.hash)
+        finally:
+            transport.close()
+            server.shutdown()
+            server.server_close()
+
+
+class TestSnapshots(unittest.TestCase):
+
+    def test_history(self):
+        h = PMhistory(PMtrie.FromList(FRUITS_LIST[:10]), depth=3)
+        root0 = h.roots()[-1]
+
+        for d in FRUITS_LIST[10:20]:
+            h.insert(d['key'], d['value'])
+        root1 = h.commit()
+        h.delete(FRUITS_LIST[0]['key'])
+        h.update(FRUITS_LIST[12]['key'], '🍑')
+        for d in FRUITS_LIST[20:]:
+            h.insert(d['key'], d['value'])
+        root2 = h.commit()
+
+        self.assertEqual(h.snapshot(root0).hash.hex(), PMtrie.FromList(FRUITS_LIST[:10]).hash.hex())
+        self.assertEqual(root1.hex(), PMtrie.FromList(FRUITS_LIST[:20]).hash.hex())
+        l = [dict(d, value='🍑') if i == 12 else d for i, d in enumerate(FRUITS_LIST)][1:]
+        self.assertEqual(root2.hex(), PMtrie.FromList(l).hash.hex())
+
+        for d in FRUITS_LIST[:10]:
+            self.assertEqual(h.prove(d['key'], root0).verify(), root0)
+        self.assertEqual(h.prove(FRUITS_LIST[12]['key'], root1).verify(), root1)
+        self.assertEqual(h.prove(FRUITS_LIST[12]['key']).verify(), root2)
+
+        h.insert('kiwano[uid: 0]', '🤷')
+        h.commit()
+        self.assertEqual(len(h.roots()), 3)
+        with self.assertRaises(Exception) as context:
+            h.snapshot(root0)
+
+
+class TestProofCache(unittest.TestCase):
+
+    def test_rebase(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        cache = PMproofcache(t, capacity=100)
+        keys = [d['key'] for d in FRUITS_LIST]
+
+        for k in keys:
+            cache.prove(k)
+        self.assertEqual(cache.prove_json(keys[0]), t.prove(keys[0]).toJSON())
+        self.assertEqual(cache.hits, 1)
+
+        cache.insert('melon[uid: 0]', 'M')
+        cache.update(keys[3], 'changed')
+        cache.delete(keys[5])
+        cache.insert('fig[uid: 0]', 'F')
+        for k in keys[:5] + keys[6:] + ['melon[uid: 0]']:
+            self.assertEqual(cache.prove_cbor(k), t.prove(k).toCBOR())
+            self.assertEqual(cache.prove(k).verify(), t.hash)
+        self.assertEqual(cache.rebases, len(keys) - 1)
+
+    def test_capacity(self):
+        t = PMtrie.FromList(FRUITS_LIST)
+        cache = PMproofcache(t, capacity=4, log_size=1)
+        keys = [d['key'] for d in FRUITS_LIST]
+        for k in keys:
+            cache.prove(k)
+        self.assertEqual(len(cache.entries), 4)
+        self.assertEqual(len(cache.latest), 4)
+
+        # two mutations overflow the log, so the cached proof is not rebased
+        cache.update(keys[-1], 'a')
+        cache.update(keys[0], 'b')
+        self.assertEqual(cache.prove(keys[-1]).toCBOR(), t.prove(keys[-1]).toCBOR())
+        self.assertEqual(cache.rebases, 0)
+
+        # mutations outside the cache also disable rebasing
+        cache.prove(keys[-2])
+        t.update(keys[-2], 'c')
+        self.assertEqual(cache.prove(keys[-2]).toCBOR(), t.prove(keys[-2]).toCBOR())
+        self.assertEqual(cache.rebases, 0)
+
+    def test_mixed_mutations(self):
+        # direct mutations between cached ones must never leave rebased proofs stale
+        rng = random.Random(7)
+        keys = [f'key-{i}' for i in range(60)]
+        t = PMtrie.FromList([{'key': k, 'value': 'v'} for k in keys])
+        cache = PMproofcache(t, capacity=100)
+        for round in range(100):
+            for k in rng.sample(keys, 3):
+                target = t if rng.random() < 0.3 else cache
+                target.update(k, f'v{round}')
+            for k in rng.sample(keys, 10):
+                self.assertEqual(cache.prove(k).verify(), t.hash)
+        self.assertGreater(cache.rebases, 0)
+
+
+class TestService(unittest.TestCase):
+
+    def test_service(self):
+        async def run():
+            service = PMservice(PMtrie.FromList(FRUITS_LIST[:20]), window=0.01)
+            server = await service.start(port=0)
+            port = server.sockets[0].getsockname()[1]
+            client = await PMclient.connect(port=port)
+
+            keys = [d['key'] for d in FRUITS_LIST[:20]]
+            proofs = await asyncio.gather(*[client.request('prove', key=k) for k in keys])
+            cbor = await client.request('prove', key=keys[0], format='cbor')
+            self.assertEqual(service.batches, 2)
+            self.assertEqual(proofs[3]['path'], to_path(keys[3]))
+            self.assertTrue(await client.request('verify', proof=proofs[3]))
+            self.assertTrue(await client.request('verify', proof=cbor))
+
+            root = await client.request('insert', key=FRUITS_LIST[20]['key'], value=FRUITS_LIST[20]['value'])
+            self.assertEqual(root, PMtrie.FromList(FRUITS_LIST[:21]).hash.hex())
+            self.assertEqual(await client.request('root'), root)
+            self.assertFalse(await client.request('verify', proof=proofs[3]))
+
+            with self.assertRaises(Exception):
+                await client.request('prove', key='not a fruit')
+            with self.assertRaises(Exception):
+                await client.request('frobnicate')
+
+            await client.close()
+            server.close()
+            await server.wait_closed()
+            service.close()
+
+        asyncio.run(run())
+
+
+class TestInstrument(unittest.TestCase):
+
+    def test_profile(self):
+        original_digest = helpers.digest
+        original_insert = PMtrie.insert
+        t = PMtrie.FromList(FRUITS_LIST[:10])
+
+        with instrument.profile() as stats:
+            t.insert(FRUITS_LIST[10]['key'], FRUITS_LIST[10]['value'])
+            t.prove(FRUITS_LIST[0]['key']).verify()
+            PMproof.fromCBOR(t.prove(FRUITS_LIST[1]['key']).toCBORbytes())
+            self.assertTrue(instrument.enabled())
+
+        self.assertFalse(instrument.enabled())
+        self.assertIs(helpers.digest, original_digest)
+        self.assertIs(PMtrie.insert, original_insert)
+        self.assertEqual(stats['PMtrie.insert']['calls'], 1)
+        self.assertEqual(stats['PMtrie.insert_prehashed']['calls'], 1)
+        self.assertEqual(stats['PMtrie.prove']['calls'], 2)
+        self.assertEqual(stats['PMproof.fromCBOR']['calls'], 1)
+        self.assertGreater(stats['digest']['calls'], 0)
+        self.assertGreater(stats['to_path']['calls'], 0)
+        self.assertGreaterEqual(stats['PMtrie.insert']['seconds'], 0)
+
+        instrument.reset()
+        self.assertEqual(instrument.stats(), {})
+
+    def test_all_modules(self):
+        import cache
+        original_to_path = helpers.to_path
+        late = types.ModuleType('late_import')
+        with instrument.profile():
+            self.assertIsNot(cache.to_path, original_to_path)
+            # imported while enabled, it copies the wrappers
+            exec('from helpers import *', late.__dict__)
+            sys.modules['late_import'] = late
+        del sys.modules['late_import']
+        self.assertIs(cache.to_path, original_to_path)
+        self.assertIs(late.to_path, original_to_path)
+        self.assertIs(late.merkle_neighbors, helpers.merkle_neighbors)
+
+
+class TestBench(unittest.TestCase):
+
+    def test_suite_runs(self):
+        results = bench.run_suite([50], 5)
+        self.assertEqual([r['op'] for r in results], ['insert', 'prove', 'verify', 'toCBOR', 'toJSON', 'merkle_root'])
+        self.assertEqual(results[0]['count'], 50)
+        self.assertGreater(results[0]['blake2b_per_op'], 0)
+        self.assertEqual(results[1]['count'], 5)
+
+
+class TestArena(unittest.TestCase):
+
+    def test_arena_fruits(self):
+        t = PMarena.FromList(FRUITS_LIST)
+        self.assertEqual(t.hash.hex(), '4acd78f345a686361df77541b2e0b533f53362e36620a1fdd3a13e0b61a3b078')
+        self.assertEqual(t.size, len(FRUITS_LIST))
+
+        reference = PMtrie.FromList(FRUITS_LIST)
+        for d in FRUITS_LIST:
+            proof = t.prove(d['key'])
+            self.assertEqual(proof.toCBOR(), reference.prove(d['key']).toCBOR())
+            self.assertEqual(proof.verify().hex(), t.hash.hex())
+
+    def test_arena_matches_trie(self):
+        l = [{key: f'key-{i}', value: f'value-{i}'} for i in range(300)]
+        t = PMarena()
+        self.assertEqual(t.hash, NULL_HASH)
+        for i, d in enumerate(l):
+            t.insert(d['key'], d['value'])
+            if i % 50 == 0:
+                self.assertEqual(t.hash.hex(), PMtrie.FromList(l[:i+1]).hash.hex())
+        self.assertEqual(t.hash.hex(), PMtrie.FromList(l).hash.hex())
+        self.assertEqual(t.size, 300)
+
+        with self.assertRaises(Exception) as context:
+            t.insert('key-7', 'again')
 
 
 if __name__ == '__main__':
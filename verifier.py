@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Batch proof verification. Gives the same results as PMproof.verify, but
+# hashes only the path a proof takes, walks it iteratively and shares
+# intermediate hashes between proofs of the same batch.
+
+from concurrent.futures import ProcessPoolExecutor
+
+from helpers import *
+from pmtrie import PMtrie, PMproof, PMmultiproof
+
+def proof_root(proof, including_item=True, memo=None):
+    path  = proof.path
+    steps = proof.steps
+    if not including_item and len(steps) == 0:
+        return NULL_HASH
+
+    cursors = [0]
+    for step in steps:
+        cursors.append(cursors[-1] + 1 + step['skip'])
+
+    if including_item:
+        assert proof.value is not None
+        h = PMtrie.ComputeHash(path[cursors[-1]:], value=digest(proof.value))
+    else:
+        h = None
+
+    for ix in range(len(steps) - 1, -1, -1):
+        step = steps[ix]
+        cursor = cursors[ix]
+
+        if h is None:
+            # last step of a proof without its item: the neighbor is what remains
+            if step['type'] == PMproof.TYPE_FORK:
+                neighbor = step['neighbor']
+                h = digest(bytes([neighbor['nibble']]) + neighbor['prefix'] + neighbor['root'])
+                continue
+            elif step['type'] == PMproof.TYPE_LEAF:
+                neighbor_path = step['neighbor']['key']
+                assert neighbor_path[:cursor] == path[:cursor]
+                assert nibble(neighbor_path[cursors[ix+1]-1]) != nibble(path[cursors[ix+1]-1])
+                h = PMtrie.ComputeHash(neighbor_path[cursor:], value=step['neighbor']['value'])
+                continue
+            h = NULL_HASH
+
+        if memo is None:
+            h = PMproof.step_root(step, path, cursor, h)
+        else:
+            k = (path[:cursors[ix+1]], h, PMmultiproof.step_key(step))
+            if k not in memo:
+                memo[k] = PMproof.step_root(step, path, cursor, h)
+            h = memo[k]
+
+    return h
+
+def verify_chunk(proofs, root, including_item=True):
+    memo = {}
+    result = []
+    for proof in proofs:
+        try:
+            result.append(proof_root(proof, including_item, memo) == root)
+        except Exception:
+            result.append(False)
+    return result
+
+def verify_batch(proofs, root, including_item=True, workers=None, chunksize=1024):
+    # one bool per proof; proofs are grouped by path so neighbors share work
+    order = sorted(range(len(proofs)), key=lambda i: proofs[i].path)
+    chunks = [order[i:i+chunksize] for i in range(0, len(order), chunksize)]
+
+    if workers is not None and workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(verify_chunk, [[proofs[i] for i in chunk] for chunk in chunks], [root]*len(chunks), [including_item]*len(chunks)))
+    else:
+        results = [verify_chunk([proofs[i] for i in chunk], root, including_item) for chunk in chunks]
+
+    valid = [False]*len(proofs)
+    for chunk, result in zip(chunks, results):
+        for i, ok in zip(chunk, result):
+            valid[i] = ok
+    return valid